@@ -0,0 +1,128 @@
+"""
+adcfilter
+---------
+
+The ``adcfilter`` module filters noisy ADC readings. Each tick reads a burst
+of samples, rejects outliers with a median or a trimmed mean, and smooths the
+result with an exponential moving average. The filter uses integer math and
+preallocated storage, so a tick does not allocate memory.
+"""
+from array import array
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+try:
+    from time import ticks_us, ticks_diff
+except ImportError:  # pragma: no cover
+    from time import perf_counter
+
+    def ticks_us():
+        return int(perf_counter() * 1000000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+MEDIAN = 'median'
+TRIMMED_MEAN = 'trimmed_mean'
+
+EMA_BITS = 8  # fractional bits of the moving average
+
+
+class BurstFilter():
+    """Oversampling filter for 16-bit ADC readings.
+
+    :param read: A function that takes no arguments and returns a raw
+                 reading, such as the ``read_u16`` method of an ``ADC``.
+    :param samples: The number of readings taken in each burst.
+    :param mode: How a burst is reduced to a single value, either
+                 ``'median'`` or ``'trimmed_mean'``.
+    :param trim: The number of lowest and highest readings discarded from
+                 each burst in ``'trimmed_mean'`` mode.
+    :param ema_shift: The smoothing of the exponential moving average. Each
+                      new burst moves the average by 1/2**ema_shift of the
+                      difference, so 0 disables the smoothing.
+
+    Example::
+
+        moisture = BurstFilter(soil.read_u16, samples=9, ema_shift=2)
+        moisture.tick()
+        print(moisture.value)
+    """
+    def __init__(self, read, samples=9, mode=MEDIAN, trim=2, ema_shift=2):
+        if mode not in (MEDIAN, TRIMMED_MEAN):
+            raise ValueError('invalid filter mode')
+        if mode == TRIMMED_MEAN and samples <= 2 * trim:
+            raise ValueError('too few samples to trim')
+        self.read = read
+        self.samples = samples
+        self.mode = mode
+        self.trim = trim
+        self.ema_shift = ema_shift
+        self.buffer = array('H', [0] * samples)
+        self.ema = -1
+        #: The filtered reading, or ``None`` before the first tick.
+        self.value = None
+        #: The duration of the last tick, in microseconds.
+        self.last_cost_us = 0
+        #: The duration of the slowest tick, in microseconds.
+        self.max_cost_us = 0
+        self.total_cost_us = 0
+        self.ticks = 0
+
+    def tick(self):
+        """Read a burst of samples and update the filtered value."""
+        start = ticks_us()
+        buf = self.buffer
+        read = self.read
+        n = self.samples
+
+        # read and insertion sort the burst in place
+        for i in range(n):
+            value = read()
+            j = i
+            while j > 0 and buf[j - 1] > value:
+                buf[j] = buf[j - 1]
+                j -= 1
+            buf[j] = value
+
+        if self.mode == MEDIAN:
+            value = buf[n // 2]
+        else:
+            total = 0
+            for i in range(self.trim, n - self.trim):
+                total += buf[i]
+            value = total // (n - 2 * self.trim)
+
+        if self.ema < 0:
+            self.ema = value << EMA_BITS
+        else:
+            self.ema += ((value << EMA_BITS) - self.ema) >> self.ema_shift
+        self.value = self.ema >> EMA_BITS
+
+        cost = ticks_diff(ticks_us(), start)
+        self.last_cost_us = cost
+        if cost > self.max_cost_us:
+            self.max_cost_us = cost
+        self.total_cost_us += cost
+        self.ticks += 1
+        return self.value
+
+    def stats(self):
+        """Return the cost of the filter as a dictionary."""
+        return {
+            'ticks': self.ticks,
+            'last_cost_us': self.last_cost_us,
+            'max_cost_us': self.max_cost_us,
+            'mean_cost_us': self.total_cost_us // self.ticks
+            if self.ticks else 0,
+        }
+
+    async def run(self, interval=1):
+        """Run a tick every ``interval`` seconds. This method is a coroutine,
+        intended to run as a background task."""
+        while True:
+            self.tick()
+            await asyncio.sleep(interval)
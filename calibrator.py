@@ -0,0 +1,190 @@
+"""
+calibrator
+----------
+
+The ``calibrator`` module calibrates the capacitive soil sensor in the
+background, as a state machine that moves from ``idle`` to ``wet`` sampling,
+then ``dry`` sampling and finally ``done``. It also converts raw readings to
+moisture percentages through a lookup table built from calibration points.
+"""
+from array import array
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+try:
+    from sys import print_exception
+except ImportError:  # pragma: no cover
+    import traceback
+
+    def print_exception(exc):
+        traceback.print_exc()
+
+IDLE = 'idle'
+WET = 'wet'
+DRY = 'dry'
+DONE = 'done'
+
+MESSAGES = {
+    IDLE: 'Not calibrated',
+    WET: 'Put the sensor into water',
+    DRY: 'Put the sensor into dry soil',
+    DONE: 'Calibrated',
+}
+
+
+class Calibrator():
+    """Two-point soil sensor calibration.
+
+    :param read: A function that takes no arguments and returns a raw sensor
+                 reading.
+    :param on_done: A function that is called with the average dry and wet
+                    readings when the calibration completes.
+    :param on_update: An optional function that is called with the
+                      calibrator as argument every time the status changes.
+    :param samples: The number of readings averaged for each point.
+    :param sample_interval: The number of seconds between readings.
+    :param settle_time: The number of seconds given to the user to move the
+                        sensor before the readings for a point start.
+    :param done: Set to ``True`` if the sensor is already calibrated.
+
+    Example::
+
+        calibrator = Calibrator(soil.read_u16, save_calibration)
+        calibrator.start()
+    """
+    def __init__(self, read, on_done, on_update=None, samples=30,
+                 sample_interval=1, settle_time=10, done=False):
+        self.read = read
+        self.on_done = on_done
+        self.on_update = on_update
+        self.samples = samples
+        self.sample_interval = sample_interval
+        self.settle_time = settle_time
+        self.state = DONE if done else IDLE
+        self.settling = False
+        self.remaining = 0
+        self.values = {}
+
+    @property
+    def running(self):
+        """``True`` while a calibration is in progress."""
+        return self.state in (WET, DRY)
+
+    def start(self):
+        """Start a calibration in a background task. Returns ``False`` if a
+        calibration is already in progress."""
+        if self.running:
+            return False
+        self.values = {}
+        asyncio.create_task(self._calibrate())
+        return True
+
+    def load_points(self, points):
+        """Complete the calibration with points that were measured
+        elsewhere, without sampling the sensor.
+
+        :param points: A list of ``(raw, percent)`` calibration points.
+
+        Returns the :class:`CalibrationTable` built from the points, or
+        ``False`` if a calibration is in progress. Raises ``ValueError`` if
+        the points cannot form a table.
+        """
+        if self.running:
+            return False
+        table = CalibrationTable(points)
+        self.values = {}
+        self.settling = False
+        self.remaining = 0
+        self._update(DONE)
+        return table
+
+    def status(self):
+        """Return the calibration status as a dictionary."""
+        return {
+            'state': self.state,
+            'message': MESSAGES[self.state],
+            'settling': self.settling,
+            'remaining': self.remaining,
+            'values': self.values,
+        }
+
+    async def _calibrate(self):
+        try:
+            for state in (WET, DRY):
+                self.values[state] = await self._sample_point(state)
+            self.on_done(self.values[DRY], self.values[WET])
+            self._update(DONE)
+        except Exception as exc:
+            print_exception(exc)
+            self._update(IDLE)
+
+    async def _sample_point(self, state):
+        self.settling = True
+        self.remaining = self.settle_time
+        self._update(state)
+        while self.remaining > 0:
+            await asyncio.sleep(1)
+            self.remaining -= 1
+            self._update(state)
+        self.settling = False
+        total = 0
+        for i in range(self.samples):
+            total += self.read()
+            self.remaining = (self.samples - i - 1) * self.sample_interval
+            self._update(state)
+            await asyncio.sleep(self.sample_interval)
+        return total // self.samples
+
+    def _update(self, state):
+        self.state = state
+        if self.on_update:
+            self.on_update(self)
+
+
+class CalibrationTable():
+    """Lookup table that converts raw 16-bit readings to moisture.
+
+    :param points: A list of ``(raw, percent)`` calibration points. At least
+                   two points with different raw values are needed.
+                   Readings between points are interpolated linearly, and
+                   readings outside of the calibrated range are
+                   extrapolated from the nearest two points.
+    :param bits: The number of top bits of a reading used to index the
+                 table, which has ``2**bits + 1`` entries.
+
+    The table stores hundredths of a percent as 16-bit integers, so a
+    conversion is two table reads and integer interpolation.
+
+    Example::
+
+        table = CalibrationTable([(52000, 0), (36000, 60), (21000, 100)])
+        moisture = table.convert(soil.read_u16()) / 100
+    """
+    def __init__(self, points, bits=8):
+        points = sorted(points)
+        if len(points) < 2 or points[0][0] == points[-1][0]:
+            raise ValueError('at least two calibration points are needed')
+        self.shift = 16 - bits
+        self.mask = (1 << self.shift) - 1
+        self.points = points
+        self.table = array('h', [0] * ((1 << bits) + 1))
+        segment = 0
+        for i in range(len(self.table)):
+            raw = i << self.shift
+            while segment < len(points) - 2 and raw > points[segment + 1][0]:
+                segment += 1
+            (x0, y0), (x1, y1) = points[segment], points[segment + 1]
+            if x0 == x1:
+                percent = y1
+            else:
+                percent = y0 + (y1 - y0) * (raw - x0) / (x1 - x0)
+            self.table[i] = max(-32768, min(32767, int(percent * 100)))
+
+    def convert(self, raw):
+        """Convert a raw reading to hundredths of a percent."""
+        i = raw >> self.shift
+        a = self.table[i]
+        return a + ((self.table[i + 1] - a) * (raw & self.mask) >> self.shift)
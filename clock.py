@@ -0,0 +1,197 @@
+"""
+clock
+-----
+
+The ``clock`` module keeps wall clock time locally. The time is synchronized
+from a network source once and then derived from the monotonic tick counter,
+so reading it never requires network I/O.
+"""
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+try:
+    from time import ticks_ms, ticks_diff
+except ImportError:  # pragma: no cover
+    from time import monotonic
+
+    def ticks_ms():
+        return int(monotonic() * 1000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+try:
+    import usocket as socket
+except ImportError:
+    import socket
+
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+
+try:
+    from sys import print_exception
+except ImportError:  # pragma: no cover
+    import traceback
+
+    def print_exception(exc):
+        traceback.print_exc()
+
+NTP_DELTA = 2208988800  # seconds between 1900-01-01 and 1970-01-01
+
+
+def ntp_source(host='pool.ntp.org', timeout=1):
+    """Return a time source that queries an NTP server.
+
+    :param host: The NTP server to query.
+    :param timeout: The socket timeout, in seconds.
+
+    NTP does not provide a UTC offset, so the offset configured in the
+    :class:`Clock` is used.
+    """
+    def source():
+        query = bytearray(48)
+        query[0] = 0x1B
+        addr = socket.getaddrinfo(host, 123)[0][-1]
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.settimeout(timeout)
+            s.sendto(query, addr)
+            msg = s.recv(48)
+        finally:
+            s.close()
+        secs, frac = struct.unpack('!II', msg[40:48])
+        return (secs - NTP_DELTA) * 1000 + (frac * 1000 >> 32), None
+    return source
+
+
+def http_source(url='http://worldtimeapi.org/api/ip', timeout=2):
+    """Return a time source that queries the worldtimeapi.org HTTP API.
+
+    :param url: The API URL to query.
+    :param timeout: The socket timeout, in seconds.
+
+    The UTC offset reported by the API is applied to the clock.
+    """
+    def source():
+        import urequests
+        response = urequests.get(url, timeout=timeout)
+        try:
+            data = response.json()
+        finally:
+            response.close()
+        offset = data['utc_offset']
+        sign = -1 if offset[0] == '-' else 1
+        offset = sign * (int(offset[1:3]) * 3600 + int(offset[4:6]) * 60)
+        return data['unixtime'] * 1000, offset
+    return source
+
+
+def _civil_from_days(days):
+    # converts days since 1970-01-01 to (year, month, day), using the
+    # algorithm from http://howardhinnant.github.io/date_algorithms.html
+    days += 719468
+    era = days // 146097
+    doe = days - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    day = doy - (153 * mp + 2) // 5 + 1
+    month = mp + 3 if mp < 10 else mp - 9
+    year = yoe + era * 400 + (1 if month <= 2 else 0)
+    return year, month, day
+
+
+class Clock():
+    """Wall clock synchronized from a network time source.
+
+    :param source: A function that takes no arguments and returns a tuple
+                   with the current Unix time in milliseconds and the UTC
+                   offset in seconds, or ``None`` if the source does not know
+                   the offset. See :func:`ntp_source` and :func:`http_source`.
+                   Tests can pass a stub function that returns fixed values.
+    :param utc_offset: The UTC offset in seconds, used until a source
+                       reports a different one.
+    :param resync_interval: The number of seconds between background
+                            synchronizations.
+    :param retry_interval: The number of seconds to wait before trying again
+                           after a failed synchronization.
+
+    Until the first successful synchronization the clock counts from the
+    Unix epoch, and ``synced`` is ``False``.
+    """
+    def __init__(self, source, utc_offset=0, resync_interval=6 * 3600,
+                 retry_interval=60):
+        self.source = source
+        self.utc_offset = utc_offset
+        self.resync_interval = resync_interval
+        self.retry_interval = retry_interval
+        self.synced = False
+        self.base_ms = 0
+        self.base_ticks = ticks_ms()
+
+    def sync(self):
+        """Synchronize the clock with its source. Raises the exception from
+        the source if the synchronization fails."""
+        now_ms, utc_offset = self.source()
+        self.base_ticks = ticks_ms()
+        self.base_ms = now_ms
+        if utc_offset is not None:
+            self.utc_offset = utc_offset
+        self.synced = True
+
+    def time_ms(self):
+        """Return the current Unix time in milliseconds."""
+        return self.base_ms + ticks_diff(ticks_ms(), self.base_ticks)
+
+    def time(self):
+        """Return the current Unix time in seconds."""
+        return self.time_ms() // 1000
+
+    def isoformat(self, ms=None):
+        """Return an ISO-8601 timestamp in local time, including the UTC
+        offset.
+
+        :param ms: The Unix time in milliseconds to format. If omitted, the
+                   current time is used.
+
+        Example::
+
+            >>> clock.isoformat()
+            '2023-06-06T00:04:44.249+02:00'
+        """
+        if ms is None:
+            ms = self.time_ms()
+        secs, ms = divmod(ms, 1000)
+        days, secs = divmod(secs + self.utc_offset, 86400)
+        year, month, day = _civil_from_days(days)
+        offset = abs(self.utc_offset) // 60
+        return '{:04d}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}.{:03d}{}{:02d}:' \
+            '{:02d}'.format(year, month, day, secs // 3600, secs // 60 % 60,
+                            secs % 60, ms,
+                            '-' if self.utc_offset < 0 else '+',
+                            offset // 60, offset % 60)
+
+    async def run(self):
+        """Synchronize the clock now and then every ``resync_interval``
+        seconds. This method is a coroutine, intended to run as a background
+        task.
+
+        Note that the time sources perform blocking network I/O, which
+        stalls the event loop while it runs. Each attempt blocks for up to
+        the timeout of the source, plus the DNS lookup of the server, which
+        is not covered by the timeout. This happens once every
+        ``resync_interval`` seconds while the source is reachable, and once
+        every ``retry_interval`` seconds while it is not.
+        """
+        while True:
+            try:
+                self.sync()
+                delay = self.resync_interval
+            except Exception as exc:
+                print_exception(exc)
+                delay = self.retry_interval
+            await asyncio.sleep(delay)
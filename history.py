@@ -0,0 +1,112 @@
+"""
+history
+-------
+
+The ``history`` module keeps a fixed number of recent readings in memory,
+stored column by column in typed arrays so that the memory used is known in
+advance and does not grow.
+"""
+from array import array
+
+
+class RingBuffer():
+    """Fixed-capacity ring buffer with typed columns.
+
+    :param capacity: The maximum number of rows stored. When the buffer is
+                     full, appending a row overwrites the oldest one.
+    :param columns: A list of ``(name, typecode)`` tuples that define the
+                    columns, with typecodes as used by the ``array`` module.
+                    The first column must hold the Unix time of each row.
+
+    All the storage is allocated when the buffer is created, so for example a
+    buffer with columns of typecodes ``'l'``, ``'h'``, ``'h'`` and ``'f'``
+    uses 12 bytes per row of capacity.
+
+    Example::
+
+        history = RingBuffer(720, [('time', 'l'), ('temperature', 'h')])
+        history.append((1686002684, 21))
+    """
+    def __init__(self, capacity, columns):
+        self.capacity = capacity
+        self.names = [name for name, typecode in columns]
+        self.columns = [array(typecode, [0] * capacity)
+                        for name, typecode in columns]
+        self.start = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, values):
+        """Append a row.
+
+        :param values: A sequence with one value per column, in column order.
+        """
+        if self.count < self.capacity:
+            i = (self.start + self.count) % self.capacity
+            self.count += 1
+        else:
+            i = self.start
+            self.start = (self.start + 1) % self.capacity
+        for column, value in zip(self.columns, values):
+            column[i] = value
+
+    def query(self, since=None, limit=None, step=None):
+        """Return stored rows as a dictionary of lists, one per column.
+
+        :param since: Only return rows with a time greater than this Unix
+                      time. If omitted, all the rows are returned.
+        :param limit: The maximum number of rows to return. When there are
+                      more rows, the most recent ones are returned.
+        :param step: If given, rows are downsampled into buckets of this
+                     number of seconds. Each bucket is returned as a single
+                     row with the bucket's start time and the mean of each of
+                     the other columns.
+        """
+        times = self.columns[0]
+        first = self.count
+        if since is None:
+            first = 0
+        else:
+            # scan from the newest row, so the cost is proportional to the
+            # number of rows returned
+            while first > 0 and \
+                    times[(self.start + first - 1) % self.capacity] > since:
+                first -= 1
+        result = {name: [] for name in self.names}
+        lists = [result[name] for name in self.names]
+        if not step:
+            if limit and self.count - first > limit:
+                first = self.count - limit
+            for n in range(first, self.count):
+                i = (self.start + n) % self.capacity
+                for column, values in zip(self.columns, lists):
+                    values.append(column[i])
+            return result
+
+        bucket = None
+        sums = [0] * len(self.columns)
+        count = 0
+        for n in range(first, self.count + 1):
+            if n < self.count:
+                i = (self.start + n) % self.capacity
+                row_bucket = times[i] // step
+            else:
+                row_bucket = None  # flush the last bucket
+            if row_bucket != bucket:
+                if count:
+                    lists[0].append(bucket * step)
+                    for j in range(1, len(sums)):
+                        lists[j].append(sums[j] / count)
+                bucket = row_bucket
+                sums = [0] * len(self.columns)
+                count = 0
+            if row_bucket is not None:
+                for j in range(1, len(sums)):
+                    sums[j] += self.columns[j][i]
+                count += 1
+        if limit and len(lists[0]) > limit:
+            for values in lists:
+                del values[:len(values) - limit]
+        return result
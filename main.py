@@ -6,11 +6,17 @@ import uos
 import network
 import json
 import gc
-import urequests
 import ssd1306
-from microdot import Microdot, Response
+from microdot_asyncio import Microdot, Response
 from microdot_cors import CORS
 import uasyncio as asyncio
+from sampler import Sampler
+from clock import Clock, http_source
+from history import RingBuffer
+from readinglog import ReadingLog
+from rollup import Rollup
+from calibrator import Calibrator, CalibrationTable
+from adcfilter import BurstFilter
 
 
 # main
@@ -32,9 +38,12 @@ gc.enable()
 
 # define 
 configFile = 'config.json'
+# either "dry,wet" or a "raw,moisture" header followed by "raw,percent" lines
 calibrationFile = 'capacitive-soil-sensor-calibration.csv'
 dryMoisture = 0
 wetMoisture = 65535
+moistureTable = None
+calibrated = False
 wlan = network.WLAN(network.STA_IF)
 
 
@@ -45,8 +54,6 @@ server = ""
 port = 0
 
 # define extras
-yearBefore = "0000"
-timeBefore = "00:00"
 temperatureBefore = 0
 humidityBefore = 0
 moistureBefore = 0
@@ -58,6 +65,9 @@ dht11 = dht.DHT11(Pin(4))
 print("Initializing the (capacitive-soil-sensor)...")
 soil = ADC(Pin(26))
 
+# bursts of 9 readings, median filtered and smoothed
+moistureFilter = BurstFilter(soil.read_u16, samples=9, ema_shift=2)
+
 
 print("(capacitive-soil-sensor) Calibrating min/max values...")
 
@@ -97,24 +107,6 @@ def checkIfFileExits(file):
             print("An error occurred while checking file existence:", e)
         return False
 
-def calculateAverage(vals):
-    sum = 0 
-    for iterator in vals:
-        sum = sum + iterator
-    return int(sum / len(vals))
-
-def readSoilSensorValues():
-    count = 1
-    secs = 30
-    vals = []
-    while count <= secs:
-        vals.append(soil.read_u16())
-        print(str(secs - count) + "sec remaining...");
-        count = count + 1
-        time.sleep(1)
-    return vals
-
-
 def writeCalibrationValues(dry, wet):
     # Open the CSV file for writing
     with open(calibrationFile, 'w') as file:
@@ -167,15 +159,26 @@ if checkIfFileExits(configFile) is True:
 
 
 # calibrating the capacitive soil-sensor
-if checkIfFileExits(calibrationFile) is True:
-    print("=====================================================")
-    print("No calibration neccessary. Reading calibrated values...")
+def readCalibrationValues():
+    global dryMoisture, wetMoisture, moistureTable, calibrated
     dry_moisture = 0
     wet_moisture = 0
+    points = []
 
     with open(calibrationFile, 'r') as file:
         lines = file.readlines()
 
+    if lines and lines[0].strip() == "raw,moisture":
+        # multi-point calibration, one "raw,percent" pair per line
+        for line in lines[1:]:
+            columns = line.strip().split(',')
+
+            if len(columns) == 2:
+                points.append((int(columns[0]), float(columns[1])))
+        
+        print("Calibration points:", points)
+    
+    else:
         for line in lines:
             columns = line.strip().split(',')
 
@@ -184,114 +187,109 @@ if checkIfFileExits(calibrationFile) is True:
                 wet_moisture = int(columns[0])
                 break  
 
-    print("Dry Moisture Level:", dry_moisture)
-    print("Wet Moisture Level:", wet_moisture)
-    print("=====================================================")
-    dryMoisture = dry_moisture
-    wetMoisture = wet_moisture
-    
-else:
-    print("Hi, you are now calibrating the sensor!")
-    print("Follow the steps below to calibrate the sensor right.")
-    time.sleep(5)
-    
-    print("=====================================================")
-    print("Put the capacitive-soil-sensor in water...")
-    print("=====================================================")
-    
-    print("Waiting 10 secounds...(then reading)");
-    time.sleep(10)
-    
-    print("=====================================================")
-    print("Now put the sensor into the water!");
-    print("=====================================================")
-    
-    time.sleep(3)
-    
-    # get sensor values
-    vals = readSoilSensorValues()
+        print("Dry Moisture Level:", dry_moisture)
+        print("Wet Moisture Level:", wet_moisture)
+        dryMoisture = dry_moisture
+        wetMoisture = wet_moisture
         
-    wetMoisture = calculateAverage(vals)
+        # same as (wetMoisture-x)*100/(wetMoisture-dryMoisture)
+        points = [(wetMoisture, 0), (dryMoisture, 100)]
+    
+    # precompiled raw value to moisture conversion
+    moistureTable = CalibrationTable(points)
+    calibrated = True
+
+def writeCalibrationPoints(points):
+    with open(calibrationFile, 'w') as file:
+        file.write("raw,moisture\n")
+        for raw, percent in points:
+            file.write("{},{}\n".format(raw, percent))
+
+    print("capacitive-soil-sensor-calibration '{}' has been written successfully.".format(calibrationFile))
+
+def onCalibrated(dry, wet):
+    # save and reload, so the values are used exactly like after a reboot
+    writeCalibrationValues(dry, wet)
+    readCalibrationValues()
     
     print("=====================================================")
-    print("Dry the capacitive-soil-sensor and put it into dry soil.")
+    print("Capacitive-soil-sensor got calibrated successfully.")
     print("=====================================================")
+
+def showCalibration(calibrator):
+    status = calibrator.status()
     
-    print("Waiting 10 secounds...(then reading)");
-    time.sleep(10)
-    
+    display.fill(0)
+    display.text("Calibration:", 0, 0)
+    display.text(status["state"], 0, 15)
+    if calibrator.running:
+        display.text("wait" if status["settling"] else "reading", 0, 30)
+        display.text("{}s remaining".format(status["remaining"]), 0, 45)
+    display.show()
+
+if checkIfFileExits(calibrationFile) is True:
     print("=====================================================")
-    print("Now put the sensor into the dry soil!");
+    print("No calibration neccessary. Reading calibrated values...")
+    readCalibrationValues()
     print("=====================================================")
-    time.sleep(3)
-    
-    vals = readSoilSensorValues()
-    dryMoisture = calculateAverage(vals)
-    
-    # dryMoisture wetMoisture
-    writeCalibrationValues(dryMoisture, wetMoisture)
     
+else:
     print("=====================================================")
-    print("Capacitive-soil-sensor got calibrated successfully.")
+    print("The capacitive-soil-sensor is not calibrated yet!")
+    print("POST /calibrate/start and follow /calibrate/status.")
     print("=====================================================")
+
+# runs in the background, so the web server starts right away
+calibrator = Calibrator(
+    soil.read_u16,
+    onCalibrated,
+    on_update=showCalibration,
+    done=calibrated,
+)
     
-timeStampBefore = "2023-06-06T00:04:44.249789+02:00"
+# local clock, synced from the time-api in the background
+# each sync blocks the server for up to 2 seconds (plus the DNS lookup),
+# every 6 hours, or every minute while the time-api can't be reached
+clock = Clock(http_source("http://worldtimeapi.org/api/ip", timeout=2))
 
 # time-api stuff
 def currentTimestampRequest():
-    global timeStampBefore
-    
-    try:
-        response = urequests.get("http://worldtimeapi.org/api/ip")
-        current_time = response.json()["datetime"]
-        response.close()
-        
-        # save to prevent exceptions
-        timeStampBefore = current_time
-        
-        return timeStampBefore
-    
-    except Exception as err:
-        print("(oled) Time-api request failed...")
-        return timeStampBefore
+    # no network i/o, the clock is kept in sync by its background task
+    return clock.isoformat()
         
         
 # time api functions
 def getCurrentTime():
-    global timeBefore
- 
     current_time = currentTimestampRequest()
     
     time_parts = current_time.split("T")[1].split(":")[:2]  
     formatted_time = ":".join(time_parts)
     
-    # safe time to display something
-    timeBefore = formatted_time
-    
     return formatted_time
    
 
 # convert time-response
 def getCurrentYear():
-    global yearBefore
-    try:
-        current_time = currentTimestampRequest()
-        current_year = current_time[:4]
-        
-        yearBefore = current_year
-        
-        return current_year
-    except Exception as err:
-        return yearBefore
+    current_time = currentTimestampRequest()
+    current_year = current_time[:4]
+    
+    return current_year
      
 
 # sensor reading functions
+def measureDHT11():
+    # one measurement serves both temperature and humidity
+    try:
+        print("(dht11) measuring...")
+        dht11.measure()
+        return True
+    except Exception as err:
+        return False
+
 def getTemperatureValue():
     global temperatureBefore
     # temperature & humidity sensor 
     try:
-        print("(dht11) measuring...")
-        dht11.measure()
         temperature = dht11.temperature()
         
         # save value before current value
@@ -305,8 +303,6 @@ def getHumidityValue():
     global humidityBefore
     # temperature & humidity sensor 
     try:
-        print("(dht11) measuring...")
-        dht11.measure()
         humidity = dht11.humidity()
         
         # save value before current value
@@ -318,9 +314,11 @@ def getHumidityValue():
     
 def getMoistureValue():
     global moistureBefore
+    if not calibrated:
+        return None
     try:
-        # read moisture value and convert to percentage into the calibration range
-        moisture = (wetMoisture-soil.read_u16())*100/(wetMoisture-dryMoisture)
+        # filtered moisture value converted to percentage by table lookup
+        moisture = moistureTable.convert(moistureFilter.value) / 100
         moistureBefore = moisture
         return moisture
     except Exception as err:
@@ -345,26 +343,24 @@ def updateHumidityValue(humidity):
     display.text("Humidty: {}%".format(humidity), 0, 35)
 
 def updateMoistureValue(moisture):
+    if moisture is None:
+        display.text("Moisture: uncal.", 0, 50)
+        return
     print("Moisture: {}%".format(moisture))
     display.text("Moisture: {}%".format(moisture), 0, 50)
     
 def updateDisplay():
     
-    # measure function
-    dht11.measure()
-    
-    # initialize
-    humidity = dht11.humidity()
-    temperature = dht11.temperature()
-    moisture = getMoistureValue()
+    # latest sampled values
+    snapshot = sampler.snapshot
     
     # clear the display
     display.fill(0)
     
     # show sensor-readings
-    updateTemeperatureValue(temperature)
-    updateHumidityValue(humidity)
-    updateMoistureValue(moisture)
+    updateTemeperatureValue(snapshot["temperature"])
+    updateHumidityValue(snapshot["humidity"])
+    updateMoistureValue(snapshot["moisture"])
     
     # time-api calls
     updateCurrentYear()
@@ -373,44 +369,112 @@ def updateDisplay():
     display.show()
         
       
+# background sampling
+def readSensorValues():
+    
+    # measure function
+    measureDHT11()
+    
+    return {
+        "temperature": getTemperatureValue(),
+        "humidity": getHumidityValue(),
+        "moisture": getMoistureValue(),
+        "time": clock.time(),
+        "timestamp": currentTimestampRequest(),
+    }
+
+# sensors are read every 5 seconds, however many clients are polling
+sampler = Sampler(readSensorValues, interval=5)
+
+# the last hour of readings, 12 bytes per reading
+history = RingBuffer(720, [
+    ("time", "l"),
+    ("temperature", "h"),
+    ("humidity", "h"),
+    ("moisture", "f"),
+])
+
+@sampler.subscribe
+def recordHistory(snapshot):
+    # readings without a synced time would be stored as 1970, and moisture
+    # can't be stored before the sensor is calibrated
+    if not clock.synced or snapshot["moisture"] is None:
+        return
+    
+    history.append((
+        snapshot["time"],
+        snapshot["temperature"],
+        snapshot["humidity"],
+        snapshot["moisture"],
+    ))
+
+# per-minute, per-hour and per-day min/max/mean of the readings
+rollup = Rollup([
+    ("temperature", "h"),
+    ("humidity", "h"),
+    ("moisture", "f"),
+])
+
+@sampler.subscribe
+def recordRollup(snapshot):
+    # buckets are aligned to the wall clock
+    if not clock.synced or snapshot["moisture"] is None:
+        return
+    
+    rollup.add(snapshot["time"], (
+        snapshot["temperature"],
+        snapshot["humidity"],
+        snapshot["moisture"],
+    ))
+
+# persistent readings, written to flash every 5 minutes (60 samples)
+readingLog = ReadingLog("log", batch_size=60, flush_interval=300)
+
+@sampler.subscribe
+def recordReadingLog(snapshot):
+    # readings without a synced time can't be placed in the log
+    if not clock.synced or snapshot["moisture"] is None:
+        return
+    
+    # values are stored as tenths
+    readingLog.append((
+        snapshot["time"],
+        int(snapshot["temperature"] * 10),
+        int(snapshot["humidity"] * 10),
+        int(snapshot["moisture"] * 10),
+    ))
+
+@sampler.subscribe
+def invalidateReadings(snapshot):
+    # new readings make the cached history responses stale
+    app.invalidate_cache(readings)
+    app.invalidate_cache(readingsRollup)
+
             
 # to JSON-string functions    
 def getAllSensorValuesAsJsonString():
     
-    # measure function
-    dht11.measure()
-    
     # initialize
-    humidity = dht11.humidity()
-    temperature = dht11.temperature()
-    moisture = getMoistureValue()
-    timestamp = currentTimestampRequest()
+    snapshot = sampler.snapshot
     
     data = {
-        "temperature": temperature,
-        "humidity": humidity,
-        "moisture": moisture ,
-        "timestamp": timestamp,
+        "temperature": snapshot["temperature"],
+        "humidity": snapshot["humidity"],
+        "moisture": snapshot["moisture"],
+        "timestamp": snapshot["timestamp"],
     }
     
     dataString = json.dumps(data)
     
-    # update the display
-    # updateDisplay(temperature, humidity, moisture)
-    
     return dataString
 
 def getDHT11ValuesAsJsonString():    
-    # measure function
-    dht11.measure()
-    
     # initialize
-    humidity = dht11.humidity()
-    temperature = dht11.temperature()
+    snapshot = sampler.snapshot
 
     data = {
-        "temperature": temperature,
-        "humidity": humidity 
+        "temperature": snapshot["temperature"],
+        "humidity": snapshot["humidity"] 
     }
     
     dataString = json.dumps(data)
@@ -442,7 +506,15 @@ def getMoistureValueAsJsonString(moisture):
 # Setup web server
 app = Microdot()
 
+# the Pico W only has a few sockets, serve a few clients at a time and
+# let a few more wait for a free slot
+app.max_connections = 4
+app.max_queued_connections = 4
+
 
+# runs after every handler, so 304 and cached responses also get the
+# headers
+@app.after_request
 def add_cors_headers(request, response):
     origin = request.headers.get('Origin')
     if origin in ['http://localhost']:
@@ -452,90 +524,216 @@ def add_cors_headers(request, response):
         response.headers['Access-Control-Allow-Credentials'] = 'true'
         response.headers['Access-Control-Max-Age'] = '3600'
 
+# sample numbers restart at every boot, so tags also carry a random boot id
+bootId = "%08x" % int.from_bytes(uos.urandom(4), "big")
+
+def sampleETag(request):
+    # sensor responses only change when a new sample is taken, so pollers
+    # get a 304 without a body until then
+    return 'W/"{}-{}"'.format(bootId, sampler.seq)
+
 @app.route('/plantify')
+@app.etag(sampleETag)
 def plantify(request):
     
     data = getAllSensorValuesAsJsonString()
     
     response = Response(data)
     
-    add_cors_headers(request, response)
-    
-    # call a display function
-    # uasyncio.create_task(updateDisplay())
-    
-    print(data)
-    
     return response
 
 @app.route('/dht11')
+@app.etag(sampleETag)
 def temperaturehumidity(request):
     
     data = getDHT11ValuesAsJsonString()
     
     response = Response(data)
     
-    add_cors_headers(request, response)
-    
-    # call a display function
-    # uasyncio.create_task(updateDisplay())
-    
-    print(data)
-    
     return response
 
 
 @app.route('/humidity')
+@app.etag(sampleETag)
 def humidity(request):
     
     # read humidity
-    humidity = getHumidityValue()
+    humidity = sampler.snapshot["humidity"]
     
     response = Response(getHumidityValueAsJsonString(humidity))
-    add_cors_headers(request, response)
     
     return response
 
 
 @app.route('/temperature')
+@app.etag(sampleETag)
 def temperature(request):
     
-    # read humidity
-    temperature = getTemperatureValue()
+    # read temperature
+    temperature = sampler.snapshot["temperature"]
     
     response = Response(getTemperatureValueAsJsonString(temperature))
-    add_cors_headers(request, response)
     
     return response
 
 @app.route('/moisture')
+@app.etag(sampleETag)
 def moisture(request):
     
-    # read humidity
-    moisture = getMoistureValue()
+    # read moisture
+    moisture = sampler.snapshot["moisture"]
+    if moisture is None:
+        moisture = "uncalibrated"
     
     response = Response(getMoistureValueAsJsonString(moisture))
     
-    add_cors_headers(request, response)
+    return response
+
+# responses are reused until the next sample, see invalidateReadings
+@app.route('/history')
+@app.cache(ttl=5, vary=["args.since", "args.limit", "args.step"])
+def readings(request):
+    
+    # e.g. /history?since=1686002684&limit=100&step=60
+    data = history.query(
+        since=request.args.get("since", type=int),
+        limit=request.args.get("limit", type=int),
+        step=request.args.get("step", type=int),
+    )
+    
+    response = Response(data)
+    
+    return response
+
+def streamReadingLog(start, end):
+    # streams a json array of [time, temperature, humidity, moisture] rows
+    separator = "["
+    for record in readingLog.range(start, end):
+        yield "{}[{},{},{},{}]".format(
+            separator,
+            record[0],
+            record[1] / 10,
+            record[2] / 10,
+            record[3] / 10,
+        )
+        separator = ","
+    yield "[]" if separator == "[" else "]"
+
+@app.route('/history/range')
+def readingsRange(request):
+    
+    # e.g. /history/range?from=1686002684&to=1686006284
+    start = request.args.get("from", 0, type=int)
+    end = request.args.get("to", clock.time(), type=int)
+    
+    response = Response(streamReadingLog(start, end), headers={
+        "Content-Type": "application/json; charset=UTF-8",
+    })
+    
+    return response
+
+@app.route('/history/rollup')
+@app.cache(ttl=5, vary=["args.tier", "args.since", "args.limit"])
+def readingsRollup(request):
+    
+    # e.g. /history/rollup?tier=hour&since=1686002684&limit=24
+    try:
+        data = rollup.query(
+            request.args.get("tier", "hour"),
+            since=request.args.get("since", type=int),
+            limit=request.args.get("limit", type=int),
+        )
+    except KeyError:
+        return {"error": "tier must be minute, hour or day"}, 400
+    
+    response = Response(data)
+    
+    return response
+
+@app.route('/calibrate/start', methods=['POST'])
+def calibrateStart(request):
+    
+    if not calibrator.start():
+        return {"error": "calibration already running"}, 409
+    
+    response = Response(calibrator.status())
+    
+    return response
+
+@app.route('/calibrate/points', methods=['POST'])
+def calibratePoints(request):
+    
+    # e.g. {"points": [[52000, 0], [36000, 60], [21000, 100]]}
+    try:
+        points = [(int(raw), float(percent))
+                  for raw, percent in request.json["points"]]
+        loaded = calibrator.load_points(points)
+    except Exception as err:
+        return {"error": "invalid calibration points"}, 400
+    
+    # the sampled calibration would overwrite the points when it completes
+    if not loaded:
+        return {"error": "calibration in progress"}, 409
+    
+    writeCalibrationPoints(points)
+    readCalibrationValues()
+    
+    response = Response({"points": points})
+    
+    return response
+
+@app.route('/calibrate/status')
+def calibrateStatus(request):
+    
+    response = Response(calibrator.status())
+    
+    return response
+
+@app.route('/stats')
+def stats(request):
+    
+    data = {
+        "moistureFilter": moistureFilter.stats(),
+        "server": {
+            "activeConnections": app.active_connections,
+            "queuedConnections": app.queued_connections,
+            "droppedConnections": app.dropped_connections,
+        },
+    }
+    
+    response = Response(data)
     
     return response
 
 @app.route('/updateDisplay')
-def display(request):
+def refreshDisplay(request):
     
     updateDisplay()
     
     return 'OK'
 
 
+async def main():
+    # sync the clock in the background, so the server does not wait for it
+    asyncio.create_task(clock.run())
+    
+    # filter the soil sensor every second
+    moistureFilter.tick()
+    asyncio.create_task(moistureFilter.run(interval=1))
+    
+    # take the first sample before accepting requests
+    sampler.sample()
+    asyncio.create_task(sampler.run())
+    
+    await app.start_server(port=80)
+
+
 def start_server():
     print('Starting microdot app')
     try:
-        app.run(port=80)
+        asyncio.run(main())
     except:
         app.shutdown()
 
 
 start_server()
-
-
@@ -26,11 +26,25 @@ try:  # pragma: no cover
     def create_thread(f, *args, **kwargs):
         # use the threading module
         threading.Thread(target=f, args=args, kwargs=kwargs).start()
+
+    def create_lock():
+        return threading.Lock()
 except ImportError:  # pragma: no cover
     def create_thread(f, *args, **kwargs):
         # no threads available, call function synchronously
         f(*args, **kwargs)
 
+    class _NoLock:
+        # no threads available, locking is not needed
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+    def create_lock():
+        return _NoLock()
+
     concurrency_mode = 'sync'
 
 try:
@@ -43,6 +57,11 @@ try:
 except ImportError:
     import re
 
+try:
+    from ucollections import OrderedDict
+except ImportError:
+    from collections import OrderedDict
+
 socket_timeout_error = OSError
 try:
     import usocket as socket
@@ -53,6 +72,41 @@ except ImportError:
     except ImportError:  # pragma: no cover
         socket = None
 
+try:
+    import uselect as select
+except ImportError:
+    try:
+        import select
+    except ImportError:  # pragma: no cover
+        select = None
+
+try:
+    import uio as io
+except ImportError:
+    import io
+
+try:
+    import os
+    import signal
+except ImportError:  # pragma: no cover
+    os = signal = None
+
+from time import sleep
+
+try:
+    from time import ticks_ms, ticks_add, ticks_diff
+except ImportError:  # pragma: no cover
+    from time import monotonic
+
+    def ticks_ms():
+        return int(monotonic() * 1000)
+
+    def ticks_add(a, b):
+        return a + b
+
+    def ticks_diff(a, b):
+        return a - b
+
 MUTED_SOCKET_ERRORS = [
     32,  # Broken pipe
     54,  # Connection reset by peer
@@ -275,6 +329,192 @@ class MultiDict(dict):
         return values
 
 
+class RequestParser():
+    """Incremental parser for the request line and headers of an HTTP
+    request.
+
+    Data is fed to the parser in chunks of any size, which are copied into a
+    ``bytearray`` that is reused for all the requests parsed by the parser.
+    The line length and header count limits are enforced as the data is
+    scanned, before the request is complete. The same parser is used by the
+    threaded, the asyncio and the poll servers.
+
+    The servers feed the chunks they receive from the socket, of up to
+    ``read_size`` bytes. The bytes that follow the headers in the last chunk
+    are the start of the body, and any bytes after the body belong to the
+    next request on the connection, which the threaded and asyncio servers
+    keep in ``pending`` until that request is parsed.
+
+    Example::
+
+        parser = RequestParser()
+        while not parser.complete:
+            data = sock.recv(RequestParser.read_size)
+            data = data[parser.feed(data):]
+        # data has the start of the body
+        method, url, http_version, headers = parser.parse()
+    """
+    #: The maximum number of bytes read from the client at a time.
+    read_size = 512
+
+    #: The initial size of the buffer, which grows when a longer request is
+    #: received.
+    buffer_size = 512
+
+    def __init__(self):
+        self.buffer = bytearray(self.buffer_size)
+        self.spans = []
+        #: Bytes received after the end of the previous request, which are
+        #: the start of the next one.
+        self.pending = b''
+        self.reset()
+
+    def reset(self):
+        """Prepare the parser for a new request, reusing its buffer."""
+        #: The number of bytes of the buffer that are in use. The buffer is
+        #: overwritten in place and never shrinks, as the ``bytearray`` of
+        #: MicroPython does not support deleting slices.
+        self.length = 0
+        self.spans.clear()
+        self.line_start = 0
+        #: ``True`` when the request line and all the headers have been fed.
+        self.complete = False
+
+    def feed(self, data):
+        """Feed a chunk of data to the parser.
+
+        :param data: The bytes received.
+
+        Returns the number of bytes used. When the end of the headers is in
+        the middle of the chunk the remaining bytes are not used, as they are
+        part of the request body.
+        """
+        if self.complete:
+            return 0
+        # the lines are scanned in the chunk, with base as the position of
+        # the chunk in the buffer, and the part that is used is copied once
+        buf = self.buffer
+        spans = self.spans
+        base = self.length
+        line_start = self.line_start
+        pos = 0
+        size = len(data)
+        while pos < size:
+            nl = data.find(b'\n', pos)
+            pos = size if nl < 0 else nl + 1
+            if base + pos - line_start > Request.max_readline:
+                raise ValueError('line too long')
+            if nl < 0:
+                break
+
+            # a complete line was received, check if it is blank
+            i = line_start - base
+            if i < 0:
+                # the line started in a previous chunk, which is blank if
+                # it only has whitespace in the buffer and in this chunk
+                j = line_start
+                while j < base and buf[j] in (9, 10, 13, 32):
+                    j += 1
+                i = 0 if j == base else pos + 1  # pos + 1 is not blank
+            while i < pos and data[i] in (9, 10, 13, 32):
+                i += 1
+            if i == pos:
+                self.complete = True
+                line_start = base + pos
+                break
+            if len(spans) > Request.max_headers:
+                raise ValueError('too many headers')
+            spans.append(line_start)
+            line_start = base + pos
+
+        length = base + pos
+        if length > len(buf):
+            buf.extend(bytes(max(len(buf), length - len(buf))))
+        if pos == size:
+            buf[base:length] = data
+        else:
+            buf[base:length] = memoryview(data)[:pos]
+        self.length = length
+        self.line_start = line_start
+        return pos
+
+    def end(self):
+        """Signal that the client closed the connection. A partial last line
+        is accepted as a complete line, as ``readline()`` does."""
+        if not self.complete and self.length > self.line_start:
+            self.feed(b'\n')
+
+    def parse(self):
+        """Return the request line and headers as a tuple with the method,
+        the URL, the HTTP version and a
+        :class:`NoCaseDict <microdot.NoCaseDict>` with the headers, or
+        ``None`` if the request was empty. When the client closes the
+        connection before the blank line that ends the headers, the complete
+        lines that were received are parsed.
+
+        Each line is decoded once, without the intermediate copies made
+        when it is read with ``readline()``.
+        """
+        spans = self.spans
+        if self.length > self.line_start:
+            raise ValueError('incomplete line')
+        if not spans:
+            return None
+        mv = memoryview(self.buffer)
+        # each line ends where the next one starts, the line breaks and the
+        # blank line are removed when the values are stripped
+        n = len(spans)
+        end = spans[1] if n > 1 else self.line_start
+        method, url, http_version = str(mv[0:end], 'utf-8').split()
+        http_version = http_version.split('/', 1)[1]
+
+        headers = NoCaseDict()
+        for i in range(1, n):
+            end = spans[i + 1] if i + 1 < n else self.line_start
+            header, value = str(mv[spans[i]:end], 'utf-8').split(':', 1)
+            headers[header.lstrip()] = value.strip()
+        return method, url, http_version, headers
+
+
+class _PrefixedStream():
+    # an input stream that returns the bytes that were received with the
+    # request headers before it reads from the client stream
+    def __init__(self, data, stream):
+        self.data = data
+        self.stream = stream
+
+    def read(self, size=-1):
+        data = self.data
+        if not data:
+            return self.stream.read(size)
+        if 0 <= size < len(data):
+            self.data = data[size:]
+            return data[:size]
+        self.data = b''
+        if size < 0:
+            data += self.stream.read()
+        elif size > len(data):
+            data += self.stream.read(size - len(data))
+        return data
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def readline(self, size=-1):
+        data = self.data
+        if not data:
+            return self.stream.readline(size)
+        end = data.find(b'\n') + 1
+        if end == 0:
+            end = len(data)
+        return self.read(end if size < 0 else min(end, size))
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
 class Request():
     """An HTTP request."""
     #: Specify the maximum payload size that is accepted. Requests with larger
@@ -306,12 +546,30 @@ class Request():
     #:    Request.max_readline = 16 * 1024  # 16KB lines allowed
     max_readline = 2 * 1024
 
+    #: Specify the maximum number of headers allowed in a request. Requests
+    #: with more headers are rejected with a 400 status code.
+    max_headers = 64
+
     #: Specify a suggested read timeout to use when reading the request. Set to
     #: 0 to disable the use of a timeout. This timeout should be considered a
     #: suggestion only, as some platforms may not support it. The default is
     #: 1 second.
     socket_read_timeout = 1
 
+    #: Specify how long in seconds an idle persistent connection is kept open
+    #: waiting for the next request. Set to 0 to disable persistent
+    #: connections and close the connection after each request. The default
+    #: is 5 seconds.
+    #:
+    #: Example::
+    #:
+    #:    Request.keep_alive_timeout = 0  # one request per connection
+    keep_alive_timeout = 5
+
+    #: Specify the maximum number of requests served on a persistent
+    #: connection before it is closed.
+    max_keep_alive_requests = 100
+
     class G:
         pass
 
@@ -329,17 +587,8 @@ class Request():
         self.path = url
         #: The query string portion of the URL.
         self.query_string = None
-        #: The parsed query string, as a
-        #: :class:`MultiDict <microdot.MultiDict>` object.
-        self.args = {}
         #: A dictionary with the headers included in the request.
         self.headers = headers
-        #: A dictionary with the cookies included in the request.
-        self.cookies = {}
-        #: The parsed ``Content-Length`` header.
-        self.content_length = 0
-        #: The parsed ``Content-Type`` header.
-        self.content_type = None
         #: A general purpose container for applications to store data during
         #: the life of the request.
         self.g = Request.G()
@@ -347,17 +596,15 @@ class Request():
         self.http_version = http_version
         if '?' in self.path:
             self.path, self.query_string = self.path.split('?', 1)
-            self.args = self._parse_urlencoded(self.query_string)
 
-        if 'Content-Length' in self.headers:
-            self.content_length = int(self.headers['Content-Length'])
-        if 'Content-Type' in self.headers:
-            self.content_type = self.headers['Content-Type']
-        if 'Cookie' in self.headers:
-            for cookie in self.headers['Cookie'].split(';'):
-                name, value = cookie.strip().split('=', 1)
-                self.cookies[name] = value
+        #: The ``Content-Type`` header.
+        self.content_type = headers.get('Content-Type')
 
+        # the query string, cookies and content length are parsed on first
+        # access, as most requests do not use them, and can also be assigned
+        self._args = None
+        self._cookies = None
+        self._content_length = None
         self._body = body
         self.body_used = False
         self._stream = stream
@@ -368,7 +615,8 @@ class Request():
         self.after_request_handlers = []
 
     @staticmethod
-    def create(app, client_stream, client_addr, client_sock=None):
+    def create(app, client_stream, client_addr, client_sock=None,
+               parser=None):
         """Create a request object.
 
 
@@ -377,28 +625,47 @@ class Request():
                               be read.
         :param client_addr: The address of the client, as a tuple.
         :param client_sock: The low-level socket associated with the request.
+        :param parser: A :class:`RequestParser` to reuse. If not given, a new
+                       parser is created.
 
         This method returns a newly created ``Request`` object.
         """
-        # request line
-        line = Request._safe_readline(client_stream).strip().decode()
-        if not line:
+        if parser is None:
+            parser = RequestParser()
+        else:
+            parser.reset()
+        # read whatever the client sent, with read1() from a socket file or
+        # recv() from a MicroPython socket, as read() blocks until all the
+        # bytes requested are received
+        read = getattr(client_stream, 'read1', None) or \
+            getattr(client_stream, 'recv', None)
+        data = parser.pending
+        parser.pending = b''
+        while not parser.complete:
+            if not data:
+                if read:
+                    data = read(RequestParser.read_size)
+                else:  # pragma: no cover
+                    data = client_stream.readline(Request.max_readline + 1)
+                if not data:
+                    parser.end()
+                    break
+            data = data[parser.feed(data):]
+        request = parser.parse()
+        if request is None:
             return None
-        method, url, http_version = line.split()
-        http_version = http_version.split('/', 1)[1]
-
-        # headers
-        headers = NoCaseDict()
-        while True:
-            line = Request._safe_readline(client_stream).strip().decode()
-            if line == '':
-                break
-            header, value = line.split(':', 1)
-            value = value.strip()
-            headers[header] = value
-
+        method, url, http_version, headers = request
+        stream = client_stream
+        if data:
+            # the rest of the chunk is the start of the body, followed by the
+            # next request
+            content_length = int(headers.get('Content-Length', 0))
+            parser.pending = data[content_length:]
+            if content_length:
+                stream = _PrefixedStream(data[:content_length],
+                                         client_stream)
         return Request(app, client_addr, method, url, http_version, headers,
-                       stream=client_stream, sock=client_sock)
+                       stream=stream, sock=client_sock)
 
     def _parse_urlencoded(self, urlencoded):
         data = MultiDict()
@@ -413,6 +680,47 @@ class Request():
                     data[urldecode_bytes(k)] = urldecode_bytes(v)
         return data
 
+    @property
+    def args(self):
+        """The parsed query string, as a
+        :class:`MultiDict <microdot.MultiDict>` object."""
+        if self._args is None:
+            if self.query_string is None:
+                self._args = MultiDict()
+            else:
+                self._args = self._parse_urlencoded(self.query_string)
+        return self._args
+
+    @args.setter
+    def args(self, value):
+        self._args = value
+
+    @property
+    def cookies(self):
+        """A dictionary with the cookies included in the request."""
+        if self._cookies is None:
+            self._cookies = {}
+            if 'Cookie' in self.headers:
+                for cookie in self.headers['Cookie'].split(';'):
+                    name, value = cookie.strip().split('=', 1)
+                    self._cookies[name] = value
+        return self._cookies
+
+    @cookies.setter
+    def cookies(self, value):
+        self._cookies = value
+
+    @property
+    def content_length(self):
+        """The parsed ``Content-Length`` header."""
+        if self._content_length is None:
+            self._content_length = int(self.headers.get('Content-Length', 0))
+        return self._content_length
+
+    @content_length.setter
+    def content_length(self, value):
+        self._content_length = value
+
     @property
     def body(self):
         """The body of the request, as bytes."""
@@ -491,6 +799,16 @@ class Request():
         self.after_request_handlers.append(f)
         return f
 
+    def _consume_body(self):
+        # make sure that the request body has been fully read, so that the
+        # connection can be used for another request
+        if not self.content_length:
+            return True
+        if self.stream_used or self.content_length > Request.max_body_length:
+            return False
+        self.body
+        return True
+
     @staticmethod
     def _safe_readline(stream):
         line = stream.readline(Request.max_readline + 1)
@@ -526,6 +844,16 @@ class Response():
     }
     send_file_buffer_size = 1024
 
+    #: Bodies up to this size in bytes are sent in the same write as the
+    #: status line and headers. Larger bodies are sent in separate writes.
+    inline_body_size = 1024
+
+    #: Streaming bodies sent to HTTP/1.1 clients without a
+    #: ``Content-Length`` header use chunked transfer encoding. The pieces
+    #: produced by the body are coalesced into chunks of at least this size
+    #: in bytes, so that small pieces are not sent in separate packets.
+    chunk_size = 1024
+
     #: The content type to use for responses that do not explicitly define a
     #: ``Content-Type`` header.
     default_content_type = 'text/plain'
@@ -538,6 +866,10 @@ class Response():
     #: written to the client. Used to exit WebSocket connections cleanly.
     already_handled = None
 
+    # encoded status lines for default reasons, and encoded header names
+    _status_lines = {}
+    _header_names = {}
+
     def __init__(self, body='', status_code=200, headers=None, reason=None):
         if body is None and status_code == 200:
             body = ''
@@ -554,6 +886,8 @@ class Response():
             # this applies to bytes, file-like objects or generators
             self.body = body
         self.is_head = False
+        self.allow_chunked = False
+        self.cached_head = None
 
     def set_cookie(self, cookie, value, path=None, domain=None, expires=None,
                    max_age=None, secure=False, http_only=False):
@@ -592,56 +926,149 @@ class Response():
             self.headers['Set-Cookie'] = [http_cookie]
 
     def complete(self):
+        if self.cached_head is not None:
+            return  # the head was completed before it was cached
+        if self.status_code == 304:
+            # a 304 has no body, and its Content-Length and Content-Type
+            # would describe the representation the client already has
+            return
         if isinstance(self.body, bytes) and \
                 'Content-Length' not in self.headers:
             self.headers['Content-Length'] = str(len(self.body))
+        elif self.allow_chunked and self.body and \
+                'Content-Length' not in self.headers:
+            self.headers['Transfer-Encoding'] = 'chunked'
         if 'Content-Type' not in self.headers:
             self.headers['Content-Type'] = self.default_content_type
             if 'charset=' not in self.headers['Content-Type']:
                 self.headers['Content-Type'] += '; charset=UTF-8'
 
-    def write(self, stream):
-        self.complete()
+    def head(self):
+        """Return the status line and headers of the response, encoded into
+        a ``bytearray``."""
+        if self.cached_head is not None:
+            buf = bytearray(self.cached_head)
+        elif self.reason is None and \
+                self.status_code in self._status_lines:
+            buf = bytearray(self._status_lines[self.status_code])
+        else:
+            reason = self.reason if self.reason is not None else \
+                ('OK' if self.status_code == 200 else 'N/A')
+            status_line = 'HTTP/1.1 {status_code} {reason}\r\n'.format(
+                status_code=self.status_code, reason=reason).encode()
+            if self.reason is None and 100 <= self.status_code < 600:
+                self._status_lines[self.status_code] = status_line
+            buf = bytearray(status_line)
+
+        header_names = self._header_names
+        for header, value in self.headers.items():
+            name = header_names.get(header)
+            if name is None:
+                name = (header + ': ').encode()
+                if len(header_names) < 64:
+                    header_names[header] = name
+            if isinstance(value, list):
+                for v in value:
+                    buf += name
+                    buf += str(v).encode()
+                    buf += b'\r\n'
+            else:
+                buf += name
+                buf += str(value).encode()
+                buf += b'\r\n'
+        buf += b'\r\n'
+        return buf
 
-        # status code
-        reason = self.reason if self.reason is not None else \
-            ('OK' if self.status_code == 200 else 'N/A')
-        stream.write('HTTP/1.0 {status_code} {reason}\r\n'.format(
-            status_code=self.status_code, reason=reason).encode())
+    def write(self, stream, sock=None):
+        self.complete()
 
-        # headers
-        for header, value in self.headers.items():
-            values = value if isinstance(value, list) else [value]
-            for value in values:
-                stream.write('{header}: {value}\r\n'.format(
-                    header=header, value=value).encode())
-        stream.write(b'\r\n')
+        # status code and headers, with small bodies in the same write
+        buf = self.head()
+        if self.is_head or not self.body:
+            stream.write(buf)
+            return
+        if isinstance(self.body, bytes) and \
+                len(self.body) <= self.inline_body_size:
+            buf += self.body
+            stream.write(buf)
+            return
+        stream.write(buf)
 
         # body
-        if not self.is_head:
-            can_flush = hasattr(stream, 'flush')
+        can_flush = hasattr(stream, 'flush')
+        if sock is not None and hasattr(sock, 'sendfile') and \
+                hasattr(self.body, 'fileno') and \
+                'Content-Length' in self.headers:  # pragma: no cover
+            # let the kernel copy the file to the socket
+            if can_flush:
+                stream.flush()
             try:
-                for body in self.body_iter():
-                    if isinstance(body, str):  # pragma: no cover
-                        body = body.encode()
-                    stream.write(body)
-                    if can_flush:  # pragma: no cover
-                        stream.flush()
-            except OSError as exc:  # pragma: no cover
-                if exc.errno in MUTED_SOCKET_ERRORS:
-                    pass
-                else:
-                    raise
+                sock.sendfile(self.body, self.body.tell(),
+                              int(self.headers['Content-Length']))
+            finally:
+                self.body.close()
+            return
+        try:
+            for body in self.chunked_body_iter() if self.is_chunked() \
+                    else self.body_iter():
+                if isinstance(body, str):  # pragma: no cover
+                    body = body.encode()
+                stream.write(body)
+                if can_flush:  # pragma: no cover
+                    stream.flush()
+        except OSError as exc:  # pragma: no cover
+            if exc.errno in MUTED_SOCKET_ERRORS:
+                pass
+            else:
+                raise
+
+    def is_chunked(self):
+        """Return ``True`` if the body is sent with chunked transfer
+        encoding."""
+        return self.headers.get('Transfer-Encoding') == 'chunked'
+
+    def chunked_body_iter(self):
+        """Return a generator with the body encoded in chunks, coalescing
+        the pieces of the body into chunks of ``chunk_size`` bytes, and
+        ending with the last chunk."""
+        buf = bytearray()
+        for body in self.body_iter():
+            if isinstance(body, str):  # pragma: no cover
+                body = body.encode()
+            buf += body
+            if len(buf) >= self.chunk_size:
+                yield self._chunk(buf)
+                buf = bytearray()
+        yield self._chunk(buf) + b'0\r\n\r\n' if buf else b'0\r\n\r\n'
+
+    @staticmethod
+    def _chunk(data):
+        return '{:x}\r\n'.format(len(data)).encode() + data + b'\r\n'
 
     def body_iter(self):
         if self.body:
             if hasattr(self.body, 'read'):
-                while True:
-                    buf = self.body.read(self.send_file_buffer_size)
-                    if len(buf):
-                        yield buf
-                    if len(buf) < self.send_file_buffer_size:
+                # file bodies are read into a buffer that is reused, up to
+                # the length given in the Content-Length header, if any
+                length = self.headers.get('Content-Length')
+                remaining = int(length) if length is not None else -1
+                size = self.send_file_buffer_size
+                buf = memoryview(bytearray(size))
+                readinto = getattr(self.body, 'readinto', None)
+                while remaining:
+                    if 0 < remaining < size:
+                        size = remaining
+                    if readinto:
+                        n = readinto(buf[:size])
+                        data = buf[:n] if n else None
+                    else:  # pragma: no cover
+                        data = self.body.read(size)
+                        n = len(data)
+                    if not n:
                         break
+                    if remaining > 0:
+                        remaining -= n
+                    yield data
                 if hasattr(self.body, 'close'):  # pragma: no cover
                     self.body.close()
             elif hasattr(self.body, '__next__'):
@@ -649,6 +1076,111 @@ class Response():
             else:
                 yield self.body
 
+    def apply_range(self, req):
+        """Serve the byte range requested by the client.
+
+        :param req: The request.
+
+        When the request has a ``Range`` header with a single byte range and
+        the response is a seekable file sent with ``Accept-Ranges``, as done
+        by :meth:`send_file`, the response is changed into a 206 response
+        with the requested part of the file, or into a 416 response if the
+        range starts past the end of the file. Invalid ranges, such as one
+        that ends before it starts, are ignored and the whole file is sent.
+        Other responses are not modified.
+        """
+        if self.status_code != 200 or 'Accept-Ranges' not in self.headers \
+                or not req or 'Range' not in req.headers \
+                or 'If-Range' in req.headers:
+            return
+        units, spec = (req.headers['Range'].split('=', 1) + [''])[:2]
+        if units.strip() != 'bytes' or ',' in spec or '-' not in spec:
+            return  # multiple ranges are not supported, send the whole file
+        size = int(self.headers['Content-Length'])
+        start, end = [part.strip() for part in spec.split('-', 1)]
+        try:
+            if start:
+                start = int(start)
+                if end:
+                    end = int(end)
+                    if end < start:
+                        return  # invalid range, send the whole file
+                    end = min(end, size - 1)
+                else:
+                    end = size - 1
+            else:
+                start = max(size - int(end), 0)
+                end = size - 1 if int(end) else -1
+        except ValueError:
+            return  # invalid range, send the whole file
+        if start > end:
+            if hasattr(self.body, 'close'):  # pragma: no cover
+                self.body.close()
+            self.body = b''
+            self.status_code = 416
+            self.reason = 'Range Not Satisfiable'
+            self.headers['Content-Range'] = 'bytes */{}'.format(size)
+            self.headers['Content-Length'] = '0'
+            return
+        if start:
+            self.body.seek(start, 1)
+        self.status_code = 206
+        self.reason = 'Partial Content'
+        self.headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end,
+                                                                size)
+        self.headers['Content-Length'] = str(end - start + 1)
+
+    @classmethod
+    def cached(cls, head, body):
+        """Return a response that sends a head and body serialized earlier.
+
+        :param head: The status line and headers as bytes, without the
+                     ``Content-Length`` header and the blank line that ends
+                     the head.
+        :param body: The body as bytes.
+
+        Headers added to the response are sent after the serialized ones.
+        """
+        res = cls(body, headers={'Content-Length': str(len(body))})
+        res.cached_head = head
+        return res
+
+    @classmethod
+    def not_modified(cls, etag, headers=None):
+        """Return a ``304 Not Modified`` response, without a body.
+
+        :param etag: The ``ETag`` header of the response.
+        :param headers: A dictionary with other headers to include, such as
+                        ``Cache-Control`` or ``Vary``.
+        """
+        headers = dict(headers) if headers else {}
+        headers['ETag'] = etag
+        return cls(b'', 304, headers=headers, reason='Not Modified')
+
+    @staticmethod
+    def etag_matches(request, etag):
+        """Return ``True`` if the ``If-None-Match`` header of a request
+        matches an ETag.
+
+        :param request: The request.
+        :param etag: The ETag of the current version of the resource, with
+                     its quotes and an optional ``W/`` prefix.
+
+        The weak comparison is used, so the ``W/`` prefixes are ignored.
+        """
+        if_none_match = request.headers.get('If-None-Match')
+        if not if_none_match:
+            return False
+        if etag.startswith('W/'):
+            etag = etag[2:]
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            if tag == '*' or tag == etag:
+                return True
+        return False
+
     @classmethod
     def redirect(cls, location, status_code=302):
         """Return a redirect response.
@@ -692,6 +1224,10 @@ class Response():
                                dot. The extension given here is not considered
                                when generating the ``Content-Type`` header.
 
+        When the file is seekable, the response includes the
+        ``Content-Length`` header and accepts byte range requests, so that
+        clients can resume or seek through large files.
+
         Security note: The filename is assumed to be trusted. Never pass
         filenames provided by the user without validating and sanitizing them
         first.
@@ -714,6 +1250,15 @@ class Response():
                 if isinstance(compressed, str) else 'gzip'
 
         f = stream or open(filename + file_extension, 'rb')
+        try:
+            start = f.tell()
+            size = f.seek(0, 2) - start
+            f.seek(start)
+        except Exception:  # pragma: no cover
+            pass  # the stream is not seekable, send it in chunks
+        else:
+            headers['Content-Length'] = str(size)
+            headers['Accept-Ranges'] = 'bytes'
         return cls(body=f, status_code=status_code, headers=headers)
 
 
@@ -722,6 +1267,11 @@ class URLPattern():
         self.url_pattern = url_pattern
         self.pattern = ''
         self.args = []
+        #: The literal part of the pattern before the first dynamic segment.
+        self.prefix = None
+        #: The number of segments in the paths that can match the pattern, or
+        #: ``None`` if dynamic segments can include slashes.
+        self.segments = 0
         use_regex = False
         for segment in url_pattern.lstrip('/').split('/'):
             if segment and segment[0] == '<':
@@ -743,13 +1293,28 @@ class URLPattern():
                     pattern = type_[3:]
                 else:
                     raise ValueError('invalid URL segment type')
+                if type_ == 'path' or type_.startswith('re:'):
+                    self.segments = None
+                elif self.segments is not None:
+                    self.segments += 1
+                if self.prefix is None:
+                    self.prefix = self.pattern + '/'
                 use_regex = True
                 self.pattern += '/({pattern})'.format(pattern=pattern)
                 self.args.append({'type': type_, 'name': name})
             else:
+                if self.segments is not None:
+                    self.segments += 1
                 self.pattern += '/{segment}'.format(segment=segment)
         if use_regex:
             self.pattern = re.compile('^' + self.pattern + '$')
+        else:
+            self.prefix = self.pattern
+
+    @property
+    def is_static(self):
+        """``True`` if the pattern does not have dynamic segments."""
+        return isinstance(self.pattern, str)
 
     def match(self, path):
         if isinstance(self.pattern, str):
@@ -779,6 +1344,264 @@ class HTTPException(Exception):
         return 'HTTPException: {}'.format(self.status_code)
 
 
+class WorkerPool():
+    """Fixed set of threads that handle connections from a bounded queue.
+
+    :param f: The function that handles a connection.
+    :param threads: The number of worker threads.
+    :param queue_size: The number of connections that can wait for a free
+                       worker. Connections that do not fit are rejected.
+
+    This class requires the ``threading`` module. The worker threads are
+    started when the pool is created.
+    """
+    def __init__(self, f, threads, queue_size):
+        self.f = f
+        self.threads = threads
+        self.queue_size = queue_size
+        self.queue = []
+        self.condition = threading.Condition()
+        self.stopped = False
+        #: The number of workers that are handling a connection.
+        self.active = 0
+        #: The number of connections rejected because the queue was full.
+        self.rejected = 0
+        for i in range(threads):
+            create_thread(self._worker)
+
+    @property
+    def queued(self):
+        """The number of connections waiting for a free worker."""
+        return len(self.queue)
+
+    def submit(self, *args):
+        """Queue a connection for the next free worker. Returns ``False`` if
+        the queue is full."""
+        with self.condition:
+            if self.active + len(self.queue) >= \
+                    self.threads + self.queue_size:
+                self.rejected += 1
+                return False
+            self.queue.append(args)
+            self.condition.notify()
+        return True
+
+    def stop(self):
+        """Stop the workers once the queued connections are handled."""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def stats(self):
+        """Return the pool gauges and counters as a dictionary."""
+        return {
+            'threads': self.threads,
+            'active': self.active,
+            'queued': len(self.queue),
+            'rejected': self.rejected,
+        }
+
+    def _worker(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.stopped:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+                args = self.queue.pop(0)
+                self.active += 1
+            try:
+                self.f(*args)
+            except Exception as exc:  # pragma: no cover
+                print_exception(exc)
+            finally:
+                with self.condition:
+                    self.active -= 1
+
+
+class Connection():
+    """A client connection of the multiplexed server.
+
+    :param app: The Microdot application instance.
+    :param sock: The client socket, which is switched to non-blocking mode.
+    :param addr: The address of the client, as a tuple.
+
+    The connection is a state machine that is driven by the server loop.
+    Received data is fed to a :class:`RequestParser` and the request body is
+    buffered, up to ``Request.max_content_length`` bytes, before the request
+    is dispatched. The response is then sent as the socket accepts it, one
+    body chunk at a time.
+    """
+    #: The maximum number of bytes received from the socket at once.
+    recv_size = 1024
+
+    def __init__(self, app, sock, addr):
+        sock.setblocking(False)
+        self.app = app
+        self.sock = sock
+        self.addr = addr
+        self.parser = RequestParser()
+        self.requests = 0
+        self.request = None
+        self.body = None
+        self.content_length = 0
+        self.pending = b''
+        self.response = None
+        self.chunks = None
+        self.out = None
+        self.keep_alive = False
+        self.deadline = None
+        self._set_deadline(Request.socket_read_timeout)
+
+    @property
+    def writing(self):
+        """``True`` while a response is being sent."""
+        return self.response is not None
+
+    def expired(self, now):
+        """Return ``True`` if the connection has been inactive for longer
+        than its timeout."""
+        return self.deadline is not None and ticks_diff(now,
+                                                        self.deadline) > 0
+
+    def on_read(self):
+        """Receive data from the client. Returns ``False`` if the connection
+        must be closed."""
+        try:
+            data = self.sock.recv(self.recv_size)
+        except OSError as exc:
+            return exc.errno == errno.EAGAIN
+        if not data:
+            return False  # the client closed the connection
+        self._set_deadline(Request.socket_read_timeout)
+        return self._received(data)
+
+    def on_write(self):
+        """Send as much of the response as the socket accepts. Returns
+        ``False`` if the connection must be closed."""
+        while True:
+            if self.out is None:
+                try:
+                    chunk = next(self.chunks, None) if self.chunks else None
+                except Exception as exc:
+                    # the body failed after the head was sent, so the
+                    # client can only be told by closing the connection
+                    print_exception(exc)
+                    return False
+                if chunk is None:
+                    return self._finish()
+                if isinstance(chunk, str):  # pragma: no cover
+                    chunk = chunk.encode()
+                self.out = memoryview(chunk)
+            try:
+                sent = self.sock.send(self.out)
+            except OSError as exc:
+                if exc.errno == errno.EAGAIN:
+                    return True
+                if exc.errno not in MUTED_SOCKET_ERRORS:  # pragma: no cover
+                    print_exception(exc)
+                return False
+            self._set_deadline(Request.socket_read_timeout)
+            self.out = self.out[sent:] if sent < len(self.out) else None
+
+    def close(self):
+        """Close the connection and release the response being sent."""
+        if self.response and hasattr(self.response.body, 'close'):
+            self.response.body.close()
+        self.response = self.chunks = self.out = None
+        try:
+            self.sock.close()
+        except OSError:  # pragma: no cover
+            pass
+
+    def _received(self, data):
+        if self.request is None:
+            try:
+                used = self.parser.feed(data)
+                if not self.parser.complete:
+                    return True
+                self.request = self.parser.parse()
+                if self.request is None:
+                    return False
+                self.content_length = int(
+                    self.request[3].get('Content-Length', 0))
+            except ValueError:
+                # malformed or oversized request line or headers, answer
+                # with a 400 error and close the connection
+                self.request = None
+                self.pending = b''
+                return self._respond(None, self.app.dispatch_request(None))
+            data = data[used:]
+            if self.content_length > Request.max_content_length:
+                # the request is rejected without reading the body
+                self.content_length = 0
+            self.body = bytearray()
+        needed = self.content_length - len(self.body)
+        self.body += data[:needed]
+        self.pending = data[needed:]
+        if len(self.body) < self.content_length:
+            return True
+        return self._dispatch()
+
+    def _dispatch(self):
+        app = self.app
+        method, url, http_version, headers = self.request
+        req = Request(app, self.addr, method, url, http_version, headers,
+                      stream=io.BytesIO(self.body), sock=self.sock)
+        self.request = self.body = None
+        res = None
+        try:
+            res = app.dispatch_request(req)
+        except Exception as exc:  # pragma: no cover
+            print_exception(exc)
+        return self._respond(req, res)
+
+    def _respond(self, req, res):
+        app = self.app
+        if res is None:
+            return False
+        if res == Response.already_handled:  # pragma: no cover
+            return False
+        self.requests += 1
+        self.keep_alive = not app.shutdown_requested and \
+            app._can_keep_alive(req, res, self.requests)
+        res.headers['Connection'] = 'keep-alive' if self.keep_alive \
+            else 'close'
+        res.complete()
+        buf = res.head()
+        if not res.is_head and res.body:
+            if isinstance(res.body, bytes) and \
+                    len(res.body) <= res.inline_body_size:
+                buf += res.body
+            elif res.is_chunked():
+                self.chunks = res.chunked_body_iter()
+            else:
+                self.chunks = res.body_iter()
+        self.response = res
+        self.out = memoryview(buf)
+        if app.debug and req:  # pragma: no cover
+            print('{method} {path} {status_code}'.format(
+                method=req.method, path=req.path,
+                status_code=res.status_code))
+        return self.on_write()
+
+    def _finish(self):
+        # the response was sent, wait for the next request
+        self.response = self.chunks = None
+        if not self.keep_alive:
+            return False
+        self.parser.reset()
+        self._set_deadline(Request.keep_alive_timeout)
+        if self.pending:
+            data, self.pending = self.pending, b''
+            return self._received(data)
+        return True
+
+    def _set_deadline(self, timeout):
+        self.deadline = ticks_add(ticks_ms(), int(timeout * 1000)) \
+            if timeout else None
+
+
 class Microdot():
     """An HTTP application class.
 
@@ -803,6 +1626,16 @@ class Microdot():
         self.options_handler = self.default_options_handler
         self.debug = False
         self.server = None
+        self.worker_pool = None
+        #: The maximum number of bytes used by the responses stored by the
+        #: :func:`cache` decorator.
+        self.cache_max_size = 16 * 1024
+        self.cached_handlers = {}
+        self.etag_handlers = {}
+        self.response_cache = OrderedDict()
+        self.response_cache_size = 0
+        self.cache_lock = create_lock()
+        self._route_index = (0, {}, {}, {}, [])
 
     def route(self, url_pattern, methods=None):
         """Decorator that is used to register a function as a request handler
@@ -1046,7 +1879,135 @@ class Microdot():
         """
         raise HTTPException(status_code, reason)
 
-    def run(self, host='0.0.0.0', port=5000, debug=False, ssl=None):
+    def cache(self, ttl=5, vary=None):
+        """Decorator that stores the responses of a route handler, so that
+        the handler does not run again for the same request during the given
+        time.
+
+        :param ttl: The number of seconds a response is reused.
+        :param vary: A list of request attributes that select different
+                     responses, in addition to the URL arguments. Each item
+                     is the name of a request attribute, such as ``'path'``,
+                     or the name of a dictionary attribute and a key
+                     separated by a dot, such as ``'args.fields'``,
+                     ``'headers.Origin'`` or ``'cookies.session'``.
+
+        Only 200 responses to ``GET`` and ``HEAD`` requests that have a
+        bytes body and do not set cookies are stored. The status line and
+        headers are stored serialized, together with the body, and the least
+        recently used responses are evicted when the total size exceeds
+        :attr:`cache_max_size`. Before request handlers run for all
+        requests, and after request handlers run on all the responses,
+        including the ones returned from the cache. The decorator can be
+        used in any order with the route decorator.
+
+        Example::
+
+            @app.route('/history')
+            @app.cache(ttl=10, vary=['args.since'])
+            def history(request):
+                return build_history(request.args.get('since'))
+        """
+        def decorated(f):
+            self.cached_handlers[f] = (ttl, vary or [])
+            return f
+        return decorated
+
+    def etag(self, get_etag):
+        """Decorator that adds conditional request support to a route
+        handler.
+
+        :param get_etag: A function that takes the request and the URL
+                         arguments of the route and returns the ETag of the
+                         current response, with its quotes and an optional
+                         ``W/`` prefix, or ``None`` to skip the check.
+
+        The ETag is computed before the handler runs. For ``GET`` and
+        ``HEAD`` requests with a matching ``If-None-Match`` header the
+        handler is not called and a ``304 Not Modified`` response is sent
+        instead. Otherwise the ETag is added to the handler's response when
+        its status code is 200. The decorator can be used in any order with
+        the route decorator.
+
+        Example::
+
+            @app.route('/readings')
+            @app.etag(lambda request: 'W/"{}"'.format(sampler.seq))
+            def readings(request):
+                return sampler.snapshot
+        """
+        def decorated(f):
+            self.etag_handlers[f] = get_etag
+            return f
+        return decorated
+
+    def invalidate_cache(self, f=None):
+        """Remove stored responses from the cache.
+
+        :param f: The handler function to remove the responses of. If not
+                  given, all the responses are removed.
+        """
+        with self.cache_lock:
+            for key in [key for key in self.response_cache
+                        if f is None or key[0] == f]:
+                entry = self.response_cache.pop(key)
+                self.response_cache_size -= len(entry[1]) + len(entry[2])
+
+    def _cache_lookup(self, f, req):
+        # return the cache key and None when the response of the handler is
+        # not in the cache, or None and the stored head and body when it is
+        if req.method not in ('GET', 'HEAD'):
+            return None, None
+        ttl, vary = self.cached_handlers[f]
+        key = [f, tuple(sorted(req.url_args.items()))]
+        for item in vary:
+            name, attr = (item.split('.', 1) + [None])[:2]
+            value = getattr(req, name, None)
+            if attr is not None and value is not None:
+                value = value.get(attr)
+            key.append(value)
+        key = tuple(key)
+        with self.cache_lock:
+            entry = self.response_cache.pop(key, None)
+            if entry is None:
+                return key, None
+            if ticks_diff(ticks_ms(), entry[0]) >= 0:
+                self.response_cache_size -= len(entry[1]) + len(entry[2])
+                return key, None  # expired
+            self.response_cache[key] = entry  # most recently used
+        return None, entry[1:]
+
+    def _cache_store(self, key, res):
+        if res.status_code != 200 or not isinstance(res.body, bytes) or \
+                'Set-Cookie' in res.headers:
+            return
+        res.complete()
+        headers = res.headers
+        res.headers = NoCaseDict({
+            header: value for header, value in headers.items()
+            if header.lower() != 'content-length'})
+        head = bytes(res.head()[:-2])
+        res.headers = headers
+        size = len(head) + len(res.body)
+        if size > self.cache_max_size:
+            return
+        ttl = self.cached_handlers[key[0]][0]
+        cache = self.response_cache
+        with self.cache_lock:
+            # another thread may have stored the same response meanwhile
+            entry = cache.pop(key, None)
+            if entry is not None:
+                self.response_cache_size -= len(entry[1]) + len(entry[2])
+            while cache and \
+                    self.response_cache_size + size > self.cache_max_size:
+                entry = cache.pop(next(iter(cache)))
+                self.response_cache_size -= len(entry[1]) + len(entry[2])
+            cache[key] = (ticks_add(ticks_ms(), int(ttl * 1000)), head,
+                          res.body)
+            self.response_cache_size += size
+
+    def run(self, host='0.0.0.0', port=5000, debug=False, ssl=None,
+            threads=None, queue_size=16, workers=None):
         """Start the web server. This function does not normally return, as
         the server enters an endless listening loop. The :func:`shutdown`
         function provides a method for terminating the server gracefully.
@@ -1064,6 +2025,29 @@ class Microdot():
                       default is ``False``.
         :param ssl: An ``SSLContext`` instance or ``None`` if the server should
                     not use TLS. The default is ``None``.
+        :param threads: The number of worker threads that handle connections,
+                        or ``None`` to start a new thread for each
+                        connection. The default is ``None``. This option is
+                        ignored when threads are not available.
+        :param queue_size: The number of connections that can wait for a
+                           free worker thread. When the queue is full, new
+                           connections receive a 503 response. The default
+                           is 16.
+        :param workers: The number of worker processes that accept
+                        connections on the listening socket, or ``None`` to
+                        serve from the current process. The default is
+                        ``None``. This option requires ``os.fork()``, and is
+                        ignored when it is not available.
+
+        With multiple workers, the current process supervises them. Workers
+        that crash are restarted, and ``SIGTERM`` or ``SIGINT`` stop all the
+        workers gracefully. A call to :func:`shutdown` from a route handler
+        stops all the workers as well.
+
+        When threads are not available, the server handles all the
+        connections from a single loop based on ``select.poll()``, with
+        non-blocking sockets. This is not possible with TLS, so in that case
+        the connections are handled one at a time.
 
         Example::
 
@@ -1094,18 +2078,166 @@ class Microdot():
         if ssl:
             self.server = ssl.wrap_socket(self.server, server_side=True)
 
+        if workers and signal and hasattr(os, 'fork'):  # pragma: no cover
+            self._supervise(workers, ssl, threads, queue_size)
+        else:
+            self._serve(ssl, threads, queue_size)
+
+    def _serve(self, ssl, threads, queue_size):
+        if concurrency_mode == 'sync' and select and not ssl:
+            self._serve_multiplexed()
+            return
+        if threads and concurrency_mode == 'threaded':
+            self.worker_pool = WorkerPool(self.handle_request, threads,
+                                          queue_size)
+
         while not self.shutdown_requested:
             try:
                 sock, addr = self.server.accept()
             except OSError as exc:  # pragma: no cover
-                if exc.errno == errno.ECONNABORTED:
+                if exc.errno == errno.ECONNABORTED or self.shutdown_requested:
                     break
                 else:
                     print_exception(exc)
             except Exception as exc:  # pragma: no cover
                 print_exception(exc)
             else:
-                create_thread(self.handle_request, sock, addr)
+                if self.worker_pool is None:
+                    create_thread(self.handle_request, sock, addr)
+                elif not self.worker_pool.submit(sock, addr):
+                    self._reject(sock)
+        if self.worker_pool:
+            self.worker_pool.stop()
+            self.worker_pool = None
+
+    def _supervise(self, workers, ssl, threads,
+                   queue_size):  # pragma: no cover
+        # fork the worker processes, restart the ones that crash and forward
+        # termination signals to them
+        children = set()
+
+        def stop(signum, frame):
+            self.shutdown_requested = True
+            for pid in children:
+                os.kill(pid, signal.SIGTERM)
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        while True:
+            while not self.shutdown_requested and len(children) < workers:
+                pid = os.fork()
+                if pid == 0:
+                    self._run_worker(ssl, threads, queue_size)
+                children.add(pid)
+            if not children:
+                break
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            children.discard(pid)
+            if self.shutdown_requested:
+                continue
+            if status == 0:
+                # a worker was shut down by the application
+                stop(signal.SIGTERM, None)
+            else:
+                print('Worker {pid} exited unexpectedly, restarting...'.format(
+                    pid=pid))
+                sleep(1)
+        self.server.close()
+
+    def _run_worker(self, ssl, threads, queue_size):  # pragma: no cover
+        signal.signal(signal.SIGTERM, self._stop_worker)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        status = 0
+        try:
+            self._serve(ssl, threads, queue_size)
+        except Exception as exc:
+            print_exception(exc)
+            status = 1
+        if concurrency_mode == 'threaded':
+            # let the requests in progress complete
+            for thread in threading.enumerate():
+                if thread is not threading.current_thread() and \
+                        not thread.daemon:
+                    thread.join()
+        os._exit(status)
+
+    def _stop_worker(self, signum, frame):  # pragma: no cover
+        self.shutdown()
+        if concurrency_mode == 'threaded':
+            # wake up the accept() call
+            self.server.close()
+
+    def _serve_multiplexed(self):
+        # without threads, serve all the connections from a single loop that
+        # waits for socket events
+        poller = select.poll()
+        self.server.setblocking(False)
+        poller.register(self.server, select.POLLIN)
+        # poll() returns the registered objects in MicroPython and file
+        # descriptors in CPython
+        by_fd = not hasattr(select, 'ipoll')
+        server_key = self.server.fileno() if by_fd else self.server
+        connections = {}
+
+        while True:
+            if self.shutdown_requested:
+                # stop accepting and close the connections that are not
+                # sending a response
+                if server_key is not None:
+                    poller.unregister(self.server)
+                    server_key = None
+                for key, conn in list(connections.items()):
+                    if not conn.writing:
+                        poller.unregister(conn.sock)
+                        conn.close()
+                        del connections[key]
+                if not connections:
+                    break
+            for event in poller.poll(1000):
+                key, flags = event[0], event[1]
+                if key == server_key:
+                    try:
+                        sock, addr = self.server.accept()
+                    except OSError as exc:  # pragma: no cover
+                        if exc.errno not in (errno.EAGAIN,
+                                             errno.ECONNABORTED):
+                            print_exception(exc)
+                        continue
+                    conn = Connection(self, sock, addr)
+                    poller.register(sock, select.POLLIN)
+                    connections[sock.fileno() if by_fd else sock] = conn
+                    continue
+                conn = connections.get(key)
+                if conn is None:  # pragma: no cover
+                    continue
+                try:
+                    if flags & (select.POLLHUP | select.POLLERR):
+                        ok = False
+                    elif conn.writing:
+                        ok = conn.on_write()
+                    else:
+                        ok = conn.on_read()
+                except Exception as exc:  # pragma: no cover
+                    # an error in one connection must not stop the server
+                    print_exception(exc)
+                    ok = False
+                if ok:
+                    poller.modify(conn.sock, select.POLLOUT if conn.writing
+                                  else select.POLLIN)
+                else:
+                    poller.unregister(conn.sock)
+                    conn.close()
+                    del connections[key]
+            now = ticks_ms()
+            for key, conn in list(connections.items()):
+                if conn.expired(now):
+                    poller.unregister(conn.sock)
+                    conn.close()
+                    del connections[key]
+        self.server.close()
 
     def shutdown(self):
         """Request a server shutdown. The server will then exit its request
@@ -1129,48 +2261,136 @@ class Microdot():
         if method == 'HEAD':
             method = 'GET'
         f = 404
-        for route_methods, route_pattern, route_handler in self.url_map:
-            req.url_args = route_pattern.match(req.path)
-            if req.url_args is not None:
-                if method in route_methods:
-                    f = route_handler
-                    break
-                else:
-                    f = 405
+        req.url_args = None
+        for route_methods, route_handler, url_args in \
+                self._match_routes(req.path):
+            if method in route_methods:
+                req.url_args = url_args
+                return route_handler
+            f = 405
         return f
 
     def default_options_handler(self, req):
-        allow = []
-        for route_methods, route_pattern, route_handler in self.url_map:
-            if route_pattern.match(req.path) is not None:
-                allow.extend(route_methods)
+        allow = self._allowed_methods(req.path)
         if 'GET' in allow:
             allow.append('HEAD')
         allow.append('OPTIONS')
         return {'Allow': ', '.join(allow)}
 
+    def _index_routes(self):
+        # static patterns are indexed by their path, and dynamic patterns by
+        # their number of segments, so that only the routes that can match a
+        # given path are compared against it. Routes are stored with their
+        # position in the URL map to preserve the matching order. The index
+        # is built aside and published with a single assignment, so that
+        # other threads never see it half built.
+        index = self._route_index
+        if index[0] == len(self.url_map):
+            return index
+        url_map = list(self.url_map)
+        static_routes = {}
+        static_methods = {}
+        dynamic_routes = {}
+        variable_routes = []
+        for i, (methods, pattern, handler) in enumerate(url_map):
+            route = (i, methods, pattern, handler)
+            if pattern.is_static:
+                static_routes.setdefault(pattern.pattern, []).append(route)
+                static_methods.setdefault(pattern.pattern, []).extend(
+                    methods)
+            elif pattern.segments is None:
+                variable_routes.append(route)
+            else:
+                dynamic_routes.setdefault(pattern.segments, []).append(route)
+        index = (len(url_map), static_routes, static_methods, dynamic_routes,
+                 variable_routes)
+        self._route_index = index
+        return index
+
+    def _candidate_routes(self, path):
+        count, static_routes, static_methods, dynamic_routes, \
+            variable_routes = self._index_routes()
+        static = static_routes.get(path)
+        dynamic = [route for route in dynamic_routes.get(
+            path.count('/'), ()) if path.startswith(route[2].prefix)]
+        if not dynamic and not variable_routes:
+            return static or []
+        routes = (static or []) + dynamic + [
+            route for route in variable_routes
+            if path.startswith(route[2].prefix)]
+        routes.sort(key=lambda route: route[0])
+        return routes
+
+    def _match_routes(self, path):
+        for i, methods, pattern, handler in self._candidate_routes(path):
+            url_args = {} if pattern.is_static else pattern.match(path)
+            if url_args is not None:
+                yield methods, handler, url_args
+
+    def _allowed_methods(self, path):
+        count, static_routes, static_methods, dynamic_routes, \
+            variable_routes = self._index_routes()
+        if not variable_routes and path.count('/') not in dynamic_routes:
+            return list(static_methods.get(path, ()))
+        allow = []
+        for methods, handler, url_args in self._match_routes(path):
+            allow.extend(methods)
+        return allow
+
     def handle_request(self, sock, addr):
-        if Request.socket_read_timeout and \
-                hasattr(sock, 'settimeout'):  # pragma: no cover
-            sock.settimeout(Request.socket_read_timeout)
         if not hasattr(sock, 'readline'):  # pragma: no cover
             stream = sock.makefile("rwb")
         else:
             stream = sock
 
-        req = None
-        res = None
-        try:
-            req = Request.create(self, stream, addr, sock)
-            res = self.dispatch_request(req)
-        except socket_timeout_error as exc:  # pragma: no cover
-            if exc.errno and exc.errno != errno.ETIMEDOUT:
-                print_exception(exc)  # not a timeout
-        except Exception as exc:  # pragma: no cover
-            print_exception(exc)
+        parser = RequestParser()
+        requests = 0
+        while True:
+            timeout = Request.keep_alive_timeout if requests else \
+                Request.socket_read_timeout
+            if timeout and hasattr(sock, 'settimeout'):  # pragma: no cover
+                sock.settimeout(timeout)
+            req = None
+            res = None
+            try:
+                req = Request.create(self, stream, addr, sock, parser)
+                if req is None and requests:
+                    break  # the client closed the connection
+                if requests and Request.socket_read_timeout and \
+                        hasattr(sock, 'settimeout'):  # pragma: no cover
+                    sock.settimeout(Request.socket_read_timeout)
+                res = self.dispatch_request(req)
+            except socket_timeout_error as exc:  # pragma: no cover
+                if exc.errno and exc.errno != errno.ETIMEDOUT:
+                    print_exception(exc)  # not a timeout
+            except Exception as exc:  # pragma: no cover
+                print_exception(exc)
+            requests += 1
+            keep_alive = self._keep_alive(req, res, requests)
+            try:
+                if res and res != Response.already_handled:
+                    res.headers['Connection'] = \
+                        'keep-alive' if keep_alive else 'close'
+                    res.write(stream, sock)
+                    if hasattr(stream, 'flush'):  # pragma: no cover
+                        stream.flush()
+            except OSError as exc:  # pragma: no cover
+                keep_alive = False
+                if exc.errno in MUTED_SOCKET_ERRORS:
+                    pass
+                else:
+                    print_exception(exc)
+            except Exception as exc:  # pragma: no cover
+                keep_alive = False
+                print_exception(exc)
+            if self.debug and req:  # pragma: no cover
+                print('{method} {path} {status_code}'.format(
+                    method=req.method, path=req.path,
+                    status_code=res.status_code))
+            if not keep_alive:
+                break
+
         try:
-            if res and res != Response.already_handled:  # pragma: no branch
-                res.write(stream)
             stream.close()
         except OSError as exc:  # pragma: no cover
             if exc.errno in MUTED_SOCKET_ERRORS:
@@ -1183,10 +2403,52 @@ class Microdot():
             sock.close()
         if self.shutdown_requested:  # pragma: no cover
             self.server.close()
-        if self.debug and req:  # pragma: no cover
-            print('{method} {path} {status_code}'.format(
-                method=req.method, path=req.path,
-                status_code=res.status_code))
+
+    def _keep_alive(self, req, res, requests):
+        # without threads an idle connection would block the server, and
+        # with a worker pool it would block the connections in the queue
+        if concurrency_mode == 'sync' or self.shutdown_requested or \
+                (self.worker_pool and self.worker_pool.queued):
+            return False
+        return self._can_keep_alive(req, res, requests)
+
+    def _reject(self, sock):
+        # answer a connection that cannot be handled with a 503 error,
+        # without reading the request
+        res = Response('Service Unavailable', 503,
+                       headers={'Connection': 'close', 'Retry-After': '1'},
+                       reason='Service Unavailable')
+        try:
+            if hasattr(sock, 'settimeout'):  # pragma: no cover
+                sock.settimeout(1)
+            if not hasattr(sock, 'write'):  # pragma: no cover
+                stream = sock.makefile('wb')
+                res.write(stream)
+                stream.close()
+            else:
+                res.write(sock)
+        except Exception:  # pragma: no cover
+            pass
+        sock.close()
+
+    def _can_keep_alive(self, req, res, requests):
+        # decide if the connection can be used for another request after
+        # this response is sent
+        if req is None or res is None or res == Response.already_handled \
+                or not Request.keep_alive_timeout \
+                or requests >= Request.max_keep_alive_requests:
+            return False
+        connection = req.headers.get('Connection', '').lower()
+        if req.http_version == '1.0':
+            if 'keep-alive' not in connection:
+                return False
+        elif 'close' in connection:
+            return False
+        res.complete()
+        if 'Content-Length' not in res.headers and not res.is_chunked() \
+                and res.status_code != 304:
+            return False  # the end of the body is marked by closing
+        return req._consume_body()
 
     def dispatch_request(self, req):
         after_request_handled = False
@@ -1205,6 +2467,18 @@ class Microdot():
                             res = handler(req)
                             if res:
                                 break
+                        etag = None
+                        if res is None and f in self.etag_handlers and \
+                                req.method in ('GET', 'HEAD'):
+                            etag = self.etag_handlers[f](req, **req.url_args)
+                            if etag is not None and \
+                                    Response.etag_matches(req, etag):
+                                res = Response.not_modified(etag)
+                        cache_key = None
+                        if res is None and f in self.cached_handlers:
+                            cache_key, cached = self._cache_lookup(f, req)
+                            if cached:
+                                res = Response.cached(*cached)
                         if res is None:
                             res = f(req, **req.url_args)
                         if isinstance(res, tuple):
@@ -1218,6 +2492,10 @@ class Microdot():
                             res = Response(body, status_code, headers)
                         elif not isinstance(res, Response):
                             res = Response(res)
+                        if cache_key is not None:
+                            self._cache_store(cache_key, res)
+                        if etag is not None and res.status_code == 200:
+                            res.headers['ETag'] = etag
                         for handler in self.after_request_handlers:
                             res = handler(req, res) or res
                         for handler in req.after_request_handlers:
@@ -1269,6 +2547,8 @@ class Microdot():
             for handler in self.after_error_request_handlers:
                 res = handler(req, res) or res
         res.is_head = (req and req.method == 'HEAD')
+        res.allow_chunked = (req and req.http_version == '1.1')
+        res.apply_range(req)
         return res
 
 
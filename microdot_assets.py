@@ -0,0 +1,205 @@
+"""
+microdot_assets
+---------------
+
+The ``microdot_assets`` module keeps static files in memory, so that they are
+not read from flash on every request, and validates them with ETags, so that
+browsers do not download files that they already have.
+"""
+try:
+    from ucollections import OrderedDict
+except ImportError:
+    from collections import OrderedDict
+
+try:
+    import uos as os
+except ImportError:
+    import os
+
+try:
+    from uhashlib import sha256
+except ImportError:
+    try:
+        from hashlib import sha256
+    except ImportError:  # pragma: no cover
+        sha256 = None
+
+try:
+    from ubinascii import hexlify
+except ImportError:
+    from binascii import hexlify
+
+from microdot import Response, create_lock
+
+
+class AssetCache:
+    """In-memory cache of static files with LRU eviction.
+
+    :param max_size: The maximum number of bytes of file contents kept in
+                     memory. When a new file does not fit, the least recently
+                     used files are evicted.
+    :param max_file_size: Files larger than this number of bytes are not
+                          cached, they are streamed from flash instead.
+    :param gzip: If ``True``, a precompressed variant of a file, with the
+                 same name plus a ``.gz`` extension, is sent instead of the
+                 file when it exists and the client accepts gzip encoding.
+    :param response_class: The class of the responses returned. Use
+                           ``microdot_asyncio.Response`` with the asyncio
+                           server.
+
+    Files are cached by path and modification time, so a file that is
+    updated is read again on its next request. Cached files get a strong
+    ``ETag`` computed from their contents once, when they are read, and
+    larger files get one derived from their modification time and size. A
+    request with a matching ``If-None-Match`` header receives a 304 response
+    without the file being read.
+
+    Example::
+
+        assets = AssetCache(response_class=Response)
+
+        @app.route('/static/<path:path>')
+        def static(request, path):
+            if '..' in path:
+                return 'Not found', 404
+            return assets.send_file(request, 'static/' + path)
+    """
+    def __init__(self, max_size=32 * 1024, max_file_size=8 * 1024,
+                 gzip=True, response_class=Response):
+        self.max_size = max_size
+        self.max_file_size = max_file_size
+        self.gzip = gzip
+        self.response_class = response_class
+        self.entries = OrderedDict()
+        self.lock = create_lock()
+        #: The number of bytes of file contents in the cache.
+        self.size = 0
+        #: The number of requests answered from the cache.
+        self.hits = 0
+        #: The number of requests that had to read from flash.
+        self.misses = 0
+
+    def send_file(self, request, filename, content_type=None, max_age=None):
+        """Return a response with the contents of a file.
+
+        :param request: The request, used to check the ``Accept-Encoding``
+                        and ``If-None-Match`` headers.
+        :param filename: The filename of the file.
+        :param content_type: The ``Content-Type`` header to use in the
+                             response. If omitted, it is generated from the
+                             file extension.
+        :param max_age: The ``Cache-Control`` header's ``max-age`` value in
+                        seconds. If omitted, the value of the
+                        :attr:`Response.default_send_file_max_age` attribute
+                        is used.
+
+        Security note: The filename is assumed to be trusted. Never pass
+        filenames provided by the user without validating and sanitizing them
+        first.
+        """
+        extension = ''
+        st = None
+        if self.gzip and 'gzip' in request.headers.get('Accept-Encoding', ''):
+            try:
+                st = os.stat(filename + '.gz')
+                extension = '.gz'
+            except OSError:
+                pass
+        if st is None:
+            try:
+                st = os.stat(filename)
+            except OSError:
+                return 'Not found', 404
+        path = filename + extension
+        mtime, size = st[8], st[6]
+
+        key = (path, mtime)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry  # most recently used
+                self.hits += 1
+        if entry is not None:
+            etag, body, headers = entry
+        elif size > self.max_file_size:
+            # large files are streamed from flash, with an ETag derived from
+            # their modification time and size that is checked before the
+            # file is opened
+            etag = '"{:x}-{:x}"'.format(mtime, size)
+            headers = {'ETag': etag}
+            if max_age is None:
+                max_age = self.response_class.default_send_file_max_age
+            if max_age is not None:
+                headers['Cache-Control'] = 'max-age={}'.format(max_age)
+            if self.gzip:
+                headers['Vary'] = 'Accept-Encoding'
+            if Response.etag_matches(request, etag):
+                return self._not_modified(headers)
+            with self.lock:
+                self.misses += 1
+            res = self.response_class.send_file(
+                filename, content_type=content_type, max_age=max_age,
+                compressed=bool(extension), file_extension=extension)
+            for header, value in headers.items():
+                res.headers[header] = value
+            return res
+        else:
+            with self.lock:
+                self.misses += 1
+            res = self.response_class.send_file(
+                filename, content_type=content_type, max_age=max_age,
+                compressed=bool(extension), file_extension=extension)
+            body = res.body.read()
+            res.body.close()
+            if sha256:
+                etag = '"{}"'.format(
+                    hexlify(sha256(body).digest()[:8]).decode())
+            else:  # pragma: no cover
+                etag = '"{:x}-{:x}"'.format(mtime, size)
+            headers = {'ETag': etag}
+            for header in ('Content-Type', 'Content-Encoding',
+                           'Cache-Control'):
+                if header in res.headers:
+                    headers[header] = res.headers[header]
+            if self.gzip:
+                headers['Vary'] = 'Accept-Encoding'
+            with self.lock:
+                self._store(key, (etag, body, headers))
+
+        if Response.etag_matches(request, etag):
+            return self._not_modified(headers)
+        return self.response_class(body, headers=headers.copy())
+
+    def clear(self):
+        """Remove all the files from the cache."""
+        with self.lock:
+            self.entries = OrderedDict()
+            self.size = 0
+
+    def stats(self):
+        """Return the cache counters as a dictionary."""
+        with self.lock:
+            return {
+                'files': len(self.entries),
+                'size': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def _store(self, key, entry):
+        # replace older versions of the file, then evict the least recently
+        # used files until the new one fits
+        for old_key in [k for k in self.entries if k[0] == key[0]]:
+            self.size -= len(self.entries.pop(old_key)[1])
+        size = len(entry[1])
+        if size > self.max_size:
+            return
+        while self.size + size > self.max_size:
+            self.size -= len(self.entries.pop(next(iter(self.entries)))[1])
+        self.entries[key] = entry
+        self.size += size
+
+    def _not_modified(self, headers):
+        return self.response_class.not_modified(headers['ETag'], {
+            header: value for header, value in headers.items()
+            if header in ('Cache-Control', 'Vary')})
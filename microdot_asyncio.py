@@ -16,10 +16,17 @@ try:
 except ImportError:
     import io
 
+try:
+    from concurrent.futures import ThreadPoolExecutor
+    from functools import partial
+except ImportError:  # pragma: no cover
+    ThreadPoolExecutor = None
+
 from microdot import Microdot as BaseMicrodot
 from microdot import mro
 from microdot import NoCaseDict
 from microdot import Request as BaseRequest
+from microdot import RequestParser
 from microdot import Response as BaseResponse
 from microdot import print_exception
 from microdot import HTTPException
@@ -30,6 +37,13 @@ def _iscoroutine(coro):
     return hasattr(coro, 'send') and hasattr(coro, 'throw')
 
 
+async def _wait(coro, timeout):
+    # a wait_for() that skips the extra task when there is no timeout
+    if not timeout:
+        return await coro
+    return await asyncio.wait_for(coro, timeout)
+
+
 class _AsyncBytesIO:
     def __init__(self, data):
         self.stream = io.BytesIO(data)
@@ -53,9 +67,59 @@ class _AsyncBytesIO:
         pass
 
 
+class _AsyncPrefixedStream:
+    # an input stream that returns the bytes that were received with the
+    # request headers before it reads from the client stream
+    def __init__(self, data, stream):
+        self.data = data
+        self.stream = stream
+
+    async def read(self, n=-1):
+        data = self.data
+        if not data:
+            return await self.stream.read(n)
+        if 0 <= n < len(data):
+            self.data = data[n:]
+            return data[:n]
+        self.data = b''
+        if n < 0:
+            data += await self.stream.read()
+        return data
+
+    async def readline(self):  # pragma: no cover
+        data = self.data
+        end = data.find(b'\n') + 1
+        if end:
+            self.data = data[end:]
+            return data[:end]
+        self.data = b''
+        return data + await self.stream.readline()
+
+    async def readexactly(self, n):
+        data = await self.read(n)
+        if len(data) < n:
+            data += await self.stream.readexactly(n - len(data))
+        return data
+
+    def __getattr__(self, name):  # pragma: no cover
+        return getattr(self.stream, name)
+
+
 class Request(BaseRequest):
+    #: Specify the maximum number of seconds allowed to receive the request
+    #: line and headers of the first request on a connection. Later requests
+    #: on a keep-alive connection are allowed ``keep_alive_timeout`` seconds.
+    #: Set to ``None`` to disable.
+    header_timeout = 5
+
+    #: Specify the maximum number of seconds allowed to receive the request
+    #: body, when it is read before the request is dispatched. Set to
+    #: ``None`` to disable.
+    body_timeout = 10
+
     @staticmethod
-    async def create(app, client_reader, client_writer, client_addr):
+    async def create(app, client_reader, client_writer, client_addr,
+                     parser=None, header_timeout=None):
         """Create a request object.
 
         :param app: The Microdot application instance.
@@ -64,39 +128,40 @@ class Request(BaseRequest):
         :param client_writer: An output stream where the response data can be
                               written.
         :param client_addr: The address of the client, as a tuple.
+        :param parser: A :class:`RequestParser <microdot.RequestParser>` to
+                       reuse. If not given, a new parser is created.
+        :param header_timeout: The maximum number of seconds allowed to
+                               receive the request line and headers. The
+                               body is read with its own ``body_timeout``.
 
         This method is a coroutine. It returns a newly created ``Request``
         object.
         """
-        # request line
-        line = (await Request._safe_readline(client_reader)).strip().decode()
-        if not line:
+        if parser is None:
+            parser = RequestParser()
+        else:
+            parser.reset()
+        data = await _wait(Request._read_headers(client_reader, parser),
+                           header_timeout)
+        request = parser.parse()
+        if request is None:
             return None
-        method, url, http_version = line.split()
-        http_version = http_version.split('/', 1)[1]
-
-        # headers
-        headers = NoCaseDict()
-        content_length = 0
-        while True:
-            line = (await Request._safe_readline(
-                client_reader)).strip().decode()
-            if line == '':
-                break
-            header, value = line.split(':', 1)
-            value = value.strip()
-            headers[header] = value
-            if header.lower() == 'content-length':
-                content_length = int(value)
-
-        # body
+        method, url, http_version, headers = request
+        content_length = int(headers.get('Content-Length', 0))
+
+        # body, which starts with the rest of the chunk that ended the
+        # headers, followed by the next request
+        stream = client_reader
+        if data:
+            parser.pending = data[content_length:]
+            if content_length:
+                stream = _AsyncPrefixedStream(data[:content_length],
+                                              client_reader)
         body = b''
         if content_length and content_length <= Request.max_body_length:
-            body = await client_reader.readexactly(content_length)
+            body = await _wait(stream.readexactly(content_length),
+                               Request.body_timeout)
             stream = None
-        else:
-            body = b''
-            stream = client_reader
 
         return Request(app, client_addr, method, url, http_version, headers,
                        body=body, stream=stream,
@@ -108,6 +173,26 @@ class Request(BaseRequest):
             self._stream = _AsyncBytesIO(self._body)
         return self._stream
 
+    def _consume_body(self):
+        # bodies up to max_body_length are read before the request is
+        # dispatched, larger ones may have been left unread
+        return self.content_length <= Request.max_body_length
+
+    @staticmethod
+    async def _read_headers(stream, parser):
+        # feed the chunks received to the parser and return the bytes that
+        # follow the headers
+        data = parser.pending
+        parser.pending = b''
+        while not parser.complete:
+            if not data:
+                data = await stream.read(RequestParser.read_size)
+                if not data:
+                    parser.end()
+                    break
+            data = data[parser.feed(data):]
+        return data
+
     @staticmethod
     async def _safe_readline(stream):
         line = (await stream.readline())
@@ -131,31 +216,54 @@ class Response(BaseResponse):
                    default is "OK" for responses with a 200 status code and
                    "N/A" for any other status codes.
     """
+    #: Specify the maximum number of seconds allowed to send a response.
+    #: Set to ``None`` to disable.
+    write_timeout = 10
 
     async def write(self, stream):
         self.complete()
 
         try:
-            # status code
-            reason = self.reason if self.reason is not None else \
-                ('OK' if self.status_code == 200 else 'N/A')
-            await stream.awrite('HTTP/1.0 {status_code} {reason}\r\n'.format(
-                status_code=self.status_code, reason=reason).encode())
-
-            # headers
-            for header, value in self.headers.items():
-                values = value if isinstance(value, list) else [value]
-                for value in values:
-                    await stream.awrite('{header}: {value}\r\n'.format(
-                        header=header, value=value).encode())
-            await stream.awrite(b'\r\n')
+            # status code and headers, with small bodies in the same write
+            buf = self.head()
+            if self.is_head or not self.body:
+                await stream.awrite(buf)
+                return
+            if isinstance(self.body, bytes) and \
+                    len(self.body) <= self.inline_body_size:
+                buf += self.body
+                await stream.awrite(buf)
+                return
+            await stream.awrite(buf)
 
             # body
-            if not self.is_head:
+            if hasattr(stream, 'transport') and \
+                    hasattr(self.body, 'fileno') and \
+                    'Content-Length' in self.headers:  # pragma: no cover
+                # let the event loop use sendfile() when possible
+                try:
+                    await asyncio.get_running_loop().sendfile(
+                        stream.transport, self.body, self.body.tell(),
+                        int(self.headers['Content-Length']))
+                finally:
+                    self.body.close()
+                return
+            if self.is_chunked():
+                buf = bytearray()
                 async for body in self.body_iter():
                     if isinstance(body, str):  # pragma: no cover
                         body = body.encode()
-                    await stream.awrite(body)
+                    buf += body
+                    if len(buf) >= self.chunk_size:
+                        await stream.awrite(self._chunk(buf))
+                        buf = bytearray()
+                await stream.awrite(self._chunk(buf) + b'0\r\n\r\n' if buf
+                                    else b'0\r\n\r\n')
+                return
+            async for body in self.body_iter():
+                if isinstance(body, str):  # pragma: no cover
+                    body = body.encode()
+                await stream.awrite(body)
         except OSError as exc:  # pragma: no cover
             if exc.errno in MUTED_SOCKET_ERRORS or \
                     exc.args[0] == 'Connection lost':
@@ -195,21 +303,97 @@ class Response(BaseResponse):
                         return next(response.body)
                     except StopIteration:
                         raise StopAsyncIteration
-                buf = response.body.read(response.send_file_buffer_size)
-                if _iscoroutine(buf):  # pragma: no cover
-                    buf = await buf
-                if len(buf) < response.send_file_buffer_size:
+                if self.i == 2:
+                    # file bodies are read into a buffer that is reused, up
+                    # to the length given in the Content-Length header
+                    length = response.headers.get('Content-Length')
+                    self.remaining = int(length) if length is not None \
+                        else -1
+                    self.buf = memoryview(
+                        bytearray(response.send_file_buffer_size))
+                    self.i = 3
+                size = response.send_file_buffer_size
+                if 0 < self.remaining < size:
+                    size = self.remaining
+                if self.remaining and hasattr(response.body, 'readinto'):
+                    n = response.body.readinto(self.buf[:size])
+                    if _iscoroutine(n):  # pragma: no cover
+                        n = await n
+                    buf = self.buf[:n] if n else b''
+                elif self.remaining:  # pragma: no cover
+                    buf = response.body.read(size)
+                    if _iscoroutine(buf):
+                        buf = await buf
+                else:
+                    buf = b''
+                if self.remaining > 0:
+                    self.remaining -= len(buf)
+                if not buf:
                     self.i = -1
                     if hasattr(response.body, 'close'):  # pragma: no cover
                         result = response.body.close()
                         if _iscoroutine(result):
                             await result
+                    raise StopAsyncIteration
                 return buf
 
         return iter()
 
 
 class Microdot(BaseMicrodot):
+    def __init__(self):
+        super().__init__()
+        #: Set to ``True`` to run all the synchronous handlers, including
+        #: before and after request handlers and error handlers, in a thread
+        #: pool executor. Use the :func:`offload` decorator to select
+        #: individual handlers instead.
+        self.offload_handlers = False
+        #: The number of threads in the executor used for offloaded handlers.
+        self.executor_threads = 4
+        self.offloaded_handlers = set()
+        self.executor = None
+        #: The maximum number of connections served at the same time, or
+        #: ``None`` for no limit.
+        self.max_connections = None
+        #: The number of connections that can wait for a free slot when
+        #: ``max_connections`` is reached. Connections that do not fit
+        #: receive a 503 response.
+        self.max_queued_connections = 0
+        #: The number of connections being served.
+        self.active_connections = 0
+        #: The number of connections waiting for a free slot.
+        self.queued_connections = 0
+        #: The number of connections dropped by the server, by reason.
+        self.dropped_connections = {
+            'rejected': 0,
+            'header_timeout': 0,
+            'body_timeout': 0,
+            'write_timeout': 0,
+            'idle_timeout': 0,
+        }
+        self._connection_released = None
+
+    def offload(self, f):
+        """Decorator that runs a synchronous handler in a thread pool
+        executor, so that it does not block the event loop while it waits
+        for a sensor or the network. The decorator can be used with route,
+        before and after request and error handlers, in any order with the
+        decorator that registers the handler.
+
+        Offloading requires ``concurrent.futures``, which is not available
+        in MicroPython. Without it, offloaded handlers run in the event loop
+        as usual. Coroutine handlers always run in the event loop.
+
+        Example::
+
+            @app.route('/slow')
+            @app.offload
+            def slow(request):
+                return read_sensor()
+        """
+        self.offloaded_handlers.add(f)
+        return f
+
     async def start_server(self, host='0.0.0.0', port=5000, debug=False,
                            ssl=None):
         """Start the Microdot web server as a coroutine. This coroutine does
@@ -250,6 +434,7 @@ class Microdot(BaseMicrodot):
             asyncio.run(main())
         """
         self.debug = debug
+        self._connection_released = asyncio.Event()
 
         async def serve(reader, writer):
             if not hasattr(writer, 'awrite'):  # pragma: no cover
@@ -323,29 +508,108 @@ class Microdot(BaseMicrodot):
 
     def shutdown(self):
         self.server.close()
+        if self.executor:
+            self.executor.shutdown(wait=False)
+            self.executor = None
 
     async def handle_request(self, reader, writer):
-        req = None
-        try:
-            req = await Request.create(self, reader, writer,
-                                       writer.get_extra_info('peername'))
-        except Exception as exc:  # pragma: no cover
-            print_exception(exc)
-
-        res = await self.dispatch_request(req)
-        if res != Response.already_handled:  # pragma: no branch
-            await res.write(writer)
+        if await self._acquire_connection():
+            try:
+                await self._serve_connection(reader, writer)
+            finally:
+                self._release_connection()
+        else:
+            self.dropped_connections['rejected'] += 1
+            res = Response('Service Unavailable', 503,
+                           headers={'Connection': 'close', 'Retry-After': '1'},
+                           reason='Service Unavailable')
+            try:
+                await _wait(res.write(writer), Response.write_timeout)
+            except Exception:  # pragma: no cover
+                pass
         try:
-            await writer.aclose()
+            await _wait(writer.aclose(), Response.write_timeout)
+        except asyncio.TimeoutError:  # pragma: no cover
+            pass
         except OSError as exc:  # pragma: no cover
             if exc.errno in MUTED_SOCKET_ERRORS:
                 pass
             else:
                 raise
-        if self.debug and req:  # pragma: no cover
-            print('{method} {path} {status_code}'.format(
-                method=req.method, path=req.path,
-                status_code=res.status_code))
+
+    async def _serve_connection(self, reader, writer):
+        parser = RequestParser()
+        requests = 0
+        while True:
+            req = None
+            try:
+                req = await Request.create(
+                    self, reader, writer, writer.get_extra_info('peername'),
+                    parser, Request.keep_alive_timeout if requests
+                    else Request.header_timeout)
+                if req is None and requests:
+                    break  # the client closed the connection
+            except asyncio.TimeoutError:
+                if parser.complete:
+                    reason = 'body_timeout'
+                elif requests and not parser.length:
+                    reason = 'idle_timeout'
+                else:
+                    reason = 'header_timeout'
+                self.dropped_connections[reason] += 1
+                break
+            except Exception as exc:  # pragma: no cover
+                print_exception(exc)
+                if requests:
+                    break
+
+            res = await self.dispatch_request(req)
+            requests += 1
+            keep_alive = self._keep_alive(req, res, requests)
+            if res != Response.already_handled:  # pragma: no branch
+                res.headers['Connection'] = \
+                    'keep-alive' if keep_alive else 'close'
+                try:
+                    await _wait(res.write(writer), Response.write_timeout)
+                except asyncio.TimeoutError:
+                    self.dropped_connections['write_timeout'] += 1
+                    break
+            if self.debug and req:  # pragma: no cover
+                print('{method} {path} {status_code}'.format(
+                    method=req.method, path=req.path,
+                    status_code=res.status_code))
+            if not keep_alive:
+                break
+
+    async def _acquire_connection(self):
+        # wait for a connection slot, or return False if the connection must
+        # be rejected
+        if self.max_connections is None:
+            self.active_connections += 1
+            return True
+        while self.active_connections >= self.max_connections:
+            if self.queued_connections >= self.max_queued_connections:
+                return False
+            self.queued_connections += 1
+            try:
+                await self._connection_released.wait()
+            finally:
+                self.queued_connections -= 1
+        self.active_connections += 1
+        return True
+
+    def _release_connection(self):
+        self.active_connections -= 1
+        event = self._connection_released
+        self._connection_released = asyncio.Event()
+        event.set()
+
+    def _keep_alive(self, req, res, requests):
+        # a kept-alive connection holds its slot, so it is closed when other
+        # clients are waiting for one
+        if self.queued_connections:
+            return False
+        return self._can_keep_alive(req, res, requests)
 
     async def dispatch_request(self, req):
         after_request_handled = False
@@ -365,6 +629,18 @@ class Microdot(BaseMicrodot):
                             res = await self._invoke_handler(handler, req)
                             if res:
                                 break
+                        etag = None
+                        if res is None and f in self.etag_handlers and \
+                                req.method in ('GET', 'HEAD'):
+                            etag = self.etag_handlers[f](req, **req.url_args)
+                            if etag is not None and \
+                                    Response.etag_matches(req, etag):
+                                res = Response.not_modified(etag)
+                        cache_key = None
+                        if res is None and f in self.cached_handlers:
+                            cache_key, cached = self._cache_lookup(f, req)
+                            if cached:
+                                res = Response.cached(*cached)
                         if res is None:
                             res = await self._invoke_handler(
                                 f, req, **req.url_args)
@@ -379,6 +655,10 @@ class Microdot(BaseMicrodot):
                             res = Response(body, status_code, headers)
                         elif not isinstance(res, Response):
                             res = Response(res)
+                        if cache_key is not None:
+                            self._cache_store(cache_key, res)
+                        if etag is not None and res.status_code == 200:
+                            res.headers['ETag'] = etag
                         for handler in self.after_request_handlers:
                             res = await self._invoke_handler(
                                 handler, req, res) or res
@@ -395,7 +675,8 @@ class Microdot(BaseMicrodot):
                         res = 'Not found', f
                 except HTTPException as exc:
                     if exc.status_code in self.error_handlers:
-                        res = self.error_handlers[exc.status_code](req)
+                        res = await self._invoke_handler(
+                            self.error_handlers[exc.status_code], req)
                     else:
                         res = exc.reason, exc.status_code
                 except Exception as exc:
@@ -435,10 +716,20 @@ class Microdot(BaseMicrodot):
                 res = await self._invoke_handler(
                     handler, req, res) or res
         res.is_head = (req and req.method == 'HEAD')
+        res.allow_chunked = (req and req.http_version == '1.1')
+        res.apply_range(req)
         return res
 
     async def _invoke_handler(self, f_or_coro, *args, **kwargs):
-        ret = f_or_coro(*args, **kwargs)
+        if ThreadPoolExecutor and (self.offload_handlers or
+                                   f_or_coro in self.offloaded_handlers) \
+                and not asyncio.iscoroutinefunction(f_or_coro):
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(self.executor_threads)
+            ret = await asyncio.get_running_loop().run_in_executor(
+                self.executor, partial(f_or_coro, *args, **kwargs))
+        else:
+            ret = f_or_coro(*args, **kwargs)
         if _iscoroutine(ret):
             ret = await ret
         return ret
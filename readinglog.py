@@ -0,0 +1,267 @@
+"""
+readinglog
+----------
+
+The ``readinglog`` module stores readings persistently in flash, as an
+append-only log of compressed blocks split into segment files. Each segment
+has a sparse time index next to it that allows range queries to skip
+directly to the relevant blocks.
+"""
+try:
+    import uos as os
+except ImportError:
+    import os
+
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+
+try:
+    from time import ticks_ms, ticks_diff
+except ImportError:  # pragma: no cover
+    from time import monotonic
+
+    def ticks_ms():
+        return int(monotonic() * 1000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+from tscodec import BlockEncoder, decode_payload, HEADER_FORMAT, HEADER_SIZE
+
+
+class ReadingLog():
+    """Append-only log of integer records.
+
+    :param path: The directory where the segment files are stored. It is
+                 created if it does not exist.
+    :param fields: The number of integer fields in each record. The first
+                   field must be the Unix time of the record.
+    :param batch_size: The number of records buffered in RAM before they are
+                       written to flash.
+    :param flush_interval: The maximum number of seconds a record can stay
+                           in the buffer before it is written to flash.
+    :param segment_size: The approximate maximum size in bytes of a segment
+                         file. A new segment is started when the current one
+                         is full.
+    :param max_segments: The maximum number of segments to keep. The oldest
+                         segment is deleted when this number is exceeded.
+
+    Records are encoded with :mod:`tscodec` as they are appended, and each
+    flush writes the buffered records to flash as one block, which reduces
+    flash wear and the time spent writing. Records that are still in the
+    buffer are lost on a reset.
+
+    For each segment file, an index file stores the time of the first record
+    and the file offset of every block. Records must be appended in time
+    order for the index to work.
+
+    Example::
+
+        log = ReadingLog('log')
+        log.append((1686002684, 215, 480, 633))
+        for record in log.scan():
+            print(record)
+        for record in log.range(1686002684, 1686006284):
+            print(record)
+    """
+    index_format = '<lI'
+
+    def __init__(self, path='log', fields=4, batch_size=60,
+                 flush_interval=300, segment_size=64 * 1024,
+                 max_segments=8):
+        self.path = path
+        self.fields = fields
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.index_size = struct.calcsize(self.index_format)
+        self.encoder = BlockEncoder(fields)
+        self.first_time = None
+        self.buffered_ticks = 0
+        try:
+            os.mkdir(path)
+        except OSError:
+            pass  # already exists
+        segments = self.segments()
+        self.segment = segments[-1] if segments else 0
+        self.segment_used = self._size(self.segment) if segments else 0
+        if segments and not self._is_complete(self.segment):
+            # the last write was interrupted, continue in a new segment
+            self._rotate()
+
+    def segments(self):
+        """Return the sorted list of segment numbers stored in flash."""
+        return sorted([int(name[:-4]) for name in os.listdir(self.path)
+                       if name.endswith('.log')])
+
+    def segment_filename(self, segment):
+        """Return the filename of a segment."""
+        return '{}/{:08d}.log'.format(self.path, segment)
+
+    def index_filename(self, segment):
+        """Return the filename of the time index of a segment."""
+        return '{}/{:08d}.idx'.format(self.path, segment)
+
+    def append(self, record):
+        """Add a record to the log.
+
+        :param record: A tuple with the record fields, all integers.
+
+        The record is encoded into the RAM buffer. The buffer is flushed when
+        it is full or when its oldest record is older than
+        ``flush_interval`` seconds.
+        """
+        if self.encoder.count == 0:
+            self.first_time = record[0]
+            self.buffered_ticks = ticks_ms()
+        self.encoder.append(record)
+        if self.encoder.count >= self.batch_size or ticks_diff(
+                ticks_ms(), self.buffered_ticks) >= self.flush_interval * 1000:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered records to flash, as a single block."""
+        encoder = self.encoder
+        if encoder.count == 0:
+            return
+        size = HEADER_SIZE + len(encoder.payload)
+        if self.segment_used and self.segment_used + size > self.segment_size:
+            self._rotate()
+        with open(self.segment_filename(self.segment), 'ab') as f:
+            f.write(encoder.header())
+            f.write(encoder.payload)
+        with open(self.index_filename(self.segment), 'ab') as f:
+            f.write(struct.pack(self.index_format, self.first_time,
+                                self.segment_used))
+        self.segment_used += size
+        encoder.reset()
+
+    def scan(self):
+        """Return a generator that yields all the records in the log, oldest
+        first, as tuples.
+
+        Segments are read one block at a time, so the memory used does not
+        depend on the size of the log. Records that have not been flushed yet
+        are included at the end.
+        """
+        for segment in self.segments():
+            with open(self.segment_filename(segment), 'rb') as f:
+                for record in self._read_records(f):
+                    yield record
+        for record in self._buffered_records():
+            yield record
+
+    def range(self, start, end):
+        """Return a generator that yields the records with times between
+        ``start`` and ``end``, both inclusive, oldest first, as tuples.
+
+        :param start: The start Unix time.
+        :param end: The end Unix time.
+
+        The time index is used to find the first block that can be in the
+        range with a binary search, so only the blocks close to the range are
+        read and decoded.
+        """
+        entry = bytearray(self.index_size)
+        segments = self.segments()
+
+        # skip the segments that end before the start time
+        first = 0
+        for i in range(len(segments) - 1, 0, -1):
+            try:
+                idx = open(self.index_filename(segments[i]), 'rb')
+            except OSError:
+                continue  # no index
+            with idx:
+                if idx.readinto(entry) == self.index_size and \
+                        struct.unpack_from(self.index_format, entry)[0] < \
+                        start:
+                    first = i
+                    break
+
+        for segment in segments[first:]:
+            with open(self.segment_filename(segment), 'rb') as f:
+                f.seek(self._find_offset(segment, start, entry))
+                for record in self._read_records(f):
+                    if record[0] > end:
+                        return
+                    if record[0] >= start:
+                        yield record
+        for record in self._buffered_records():
+            if record[0] > end:
+                return
+            if record[0] >= start:
+                yield record
+
+    def _find_offset(self, segment, start, entry):
+        # binary search the index for the last block starting before the
+        # start time, reading one entry at a time
+        try:
+            idx = open(self.index_filename(segment), 'rb')
+        except OSError:
+            return 0  # no index, scan the whole segment
+        with idx:
+            lo = 0
+            hi = idx.seek(0, 2) // self.index_size
+            offset = 0
+            while lo < hi:
+                mid = (lo + hi) // 2
+                idx.seek(mid * self.index_size)
+                idx.readinto(entry)
+                time, block_offset = struct.unpack_from(self.index_format,
+                                                        entry)
+                if time < start:
+                    offset = block_offset
+                    lo = mid + 1
+                else:
+                    hi = mid
+        return offset
+
+    def _read_records(self, f):
+        # blocks are read into a buffer that is reused, and only replaced
+        # when a larger block is found
+        header = bytearray(HEADER_SIZE)
+        buf = bytearray(HEADER_SIZE * 64)
+        while f.readinto(header) == HEADER_SIZE:
+            length, count, fields = struct.unpack_from(HEADER_FORMAT, header)
+            if len(buf) < length:
+                buf = bytearray(length)
+            payload = memoryview(buf)[:length]
+            if f.readinto(payload) != length:
+                break  # truncated block
+            for record in decode_payload(payload, count, fields):
+                yield record
+
+    def _buffered_records(self):
+        encoder = self.encoder
+        return decode_payload(bytes(encoder.payload), encoder.count,
+                              self.fields)
+
+    def _is_complete(self, segment):
+        # walk the block headers to check that the last block is complete
+        header = bytearray(HEADER_SIZE)
+        offset = 0
+        with open(self.segment_filename(segment), 'rb') as f:
+            while f.readinto(header) == HEADER_SIZE:
+                offset += HEADER_SIZE + struct.unpack_from(HEADER_FORMAT,
+                                                           header)[0]
+                f.seek(offset)
+        return offset == self.segment_used
+
+    def _rotate(self):
+        self.segment += 1
+        self.segment_used = 0
+        segments = self.segments()
+        while len(segments) >= self.max_segments:
+            segment = segments.pop(0)
+            os.remove(self.segment_filename(segment))
+            try:
+                os.remove(self.index_filename(segment))
+            except OSError:
+                pass
+
+    def _size(self, segment):
+        return os.stat(self.segment_filename(segment))[6]
@@ -0,0 +1,126 @@
+"""
+rollup
+------
+
+The ``rollup`` module maintains round-robin aggregates of readings at
+several resolutions, in the style of RRDtool. Each resolution, or tier, keeps
+the minimum, maximum, mean and count of every field per time bucket, in its
+own fixed-size ring buffer.
+"""
+from history import RingBuffer
+
+
+class RollupTier():
+    """Aggregates for a single resolution.
+
+    :param period: The length of each bucket, in seconds.
+    :param capacity: The number of buckets stored.
+    :param fields: A list of ``(name, typecode)`` tuples with the fields to
+                   aggregate. The typecode is used for the minimum and
+                   maximum columns, the mean is always stored as a float.
+    """
+    def __init__(self, period, capacity, fields):
+        self.period = period
+        columns = [('time', 'l')]
+        for name, typecode in fields:
+            columns += [(name + '_min', typecode), (name + '_max', typecode),
+                        (name + '_mean', 'f')]
+        columns.append(('count', 'H'))
+        self.rows = RingBuffer(capacity, columns)
+        self.size = len(fields)
+        self.bucket = None
+        self.mins = [0] * self.size
+        self.maxs = [0] * self.size
+        self.sums = [0] * self.size
+        self.count = 0
+
+    def add(self, time, values):
+        """Add a reading.
+
+        :param time: The Unix time of the reading.
+        :param values: A sequence with the value of each field.
+
+        When the reading belongs to a new bucket, the current bucket is
+        stored in the ring buffer first.
+        """
+        bucket = time - time % self.period
+        if bucket != self.bucket:
+            if self.count:
+                self.rows.append(self.current())
+            self.bucket = bucket
+            self.count = 0
+        for i in range(self.size):
+            value = values[i]
+            if self.count == 0:
+                self.mins[i] = self.maxs[i] = self.sums[i] = value
+            else:
+                if value < self.mins[i]:
+                    self.mins[i] = value
+                if value > self.maxs[i]:
+                    self.maxs[i] = value
+                self.sums[i] += value
+        self.count += 1
+
+    def current(self):
+        """Return the row for the bucket in progress, in column order."""
+        row = [self.bucket]
+        for i in range(self.size):
+            row += [self.mins[i], self.maxs[i], self.sums[i] / self.count]
+        row.append(self.count)
+        return row
+
+    def query(self, since=None, limit=None):
+        """Return the stored buckets as a dictionary of lists, one per
+        column. The bucket in progress is included as the last row.
+
+        :param since: Only return buckets that start after this Unix time.
+        :param limit: The maximum number of buckets to return. When there are
+                      more buckets, the most recent ones are returned.
+        """
+        result = self.rows.query(since=since)
+        if self.count and (since is None or self.bucket > since):
+            for name, value in zip(self.rows.names, self.current()):
+                result[name].append(value)
+        if limit:
+            for values in result.values():
+                del values[:max(len(values) - limit, 0)]
+        return result
+
+
+class Rollup():
+    """Aggregates for several resolutions, updated incrementally.
+
+    :param fields: A list of ``(name, typecode)`` tuples with the fields to
+                   aggregate.
+    :param tiers: A list of ``(name, period, capacity)`` tuples that define
+                  the resolutions to maintain. The default keeps four hours
+                  of minutes, a week of hours and a year of days.
+
+    Example::
+
+        rollup = Rollup([('temperature', 'h'), ('moisture', 'f')])
+        rollup.add(1686002684, (21, 63.3))
+        rollup.query('hour', since=1686000000)
+    """
+    def __init__(self, fields, tiers=(('minute', 60, 240),
+                                      ('hour', 3600, 168),
+                                      ('day', 86400, 365))):
+        self.tiers = {name: RollupTier(period, capacity, fields)
+                      for name, period, capacity in tiers}
+
+    def add(self, time, values):
+        """Add a reading to all the tiers.
+
+        :param time: The Unix time of the reading.
+        :param values: A sequence with the value of each field.
+        """
+        for tier in self.tiers.values():
+            tier.add(time, values)
+
+    def query(self, tier, since=None, limit=None):
+        """Return the buckets of a tier. See :meth:`RollupTier.query`.
+
+        :param tier: The name of the tier. Raises ``KeyError`` if the tier
+                     does not exist.
+        """
+        return self.tiers[tier].query(since=since, limit=limit)
@@ -0,0 +1,98 @@
+"""
+sampler
+-------
+
+The ``sampler`` module reads the sensors on a fixed schedule and publishes
+the results as snapshots, so that request handlers never have to touch the
+hardware themselves.
+"""
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+try:
+    from time import ticks_ms
+except ImportError:  # pragma: no cover
+    from time import monotonic
+
+    def ticks_ms():
+        return int(monotonic() * 1000)
+
+try:
+    from sys import print_exception
+except ImportError:  # pragma: no cover
+    import traceback
+
+    def print_exception(exc):
+        traceback.print_exc()
+
+
+class Sampler():
+    """Periodic sensor sampler.
+
+    :param read: A function that takes no arguments and returns a dictionary
+                 with the current sensor values.
+    :param interval: The number of seconds between samples.
+
+    Every sample produces a new snapshot dictionary with the values returned
+    by ``read``, plus a ``seq`` key with a sequence number that increases by
+    one with each sample, and a ``ticks`` key with the ``ticks_ms()`` value
+    at which the sample was captured. A published snapshot is never modified,
+    so readers can use it without locking, and the sensor load is the same
+    regardless of how many clients are reading.
+
+    Example::
+
+        sampler = Sampler(read_sensors, interval=5)
+
+        @app.route('/values')
+        def values(request):
+            return sampler.snapshot
+    """
+    def __init__(self, read, interval=5):
+        self.read = read
+        self.interval = interval
+        self.seq = 0
+        #: The most recent snapshot, or ``None`` before the first sample.
+        self.snapshot = None
+        self.subscribers = []
+
+    def subscribe(self, f):
+        """Register a function to be called with each new snapshot. Can be
+        used as a decorator.
+
+        Example::
+
+            @sampler.subscribe
+            def on_sample(snapshot):
+                # ...
+        """
+        self.subscribers.append(f)
+        return f
+
+    def sample(self):
+        """Take a sample, publish it and return the new snapshot."""
+        snapshot = self.read()
+        self.seq += 1
+        snapshot['seq'] = self.seq
+        snapshot['ticks'] = ticks_ms()
+        self.snapshot = snapshot
+        for f in self.subscribers:
+            try:
+                f(snapshot)
+            except Exception as exc:
+                print_exception(exc)
+        return snapshot
+
+    async def run(self):
+        """Sample forever, every ``interval`` seconds. This method is a
+        coroutine, intended to run as a background task. The first sample is
+        taken after one interval, so :meth:`sample` should be called once
+        before starting the task if a snapshot is needed right away."""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.sample()
+            except Exception as exc:
+                print_exception(exc)
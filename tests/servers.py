@@ -0,0 +1,114 @@
+"""Helpers that serve raw requests through the three servers, over a socket
+pair, and split the responses that are sent back."""
+import asyncio
+import socket
+
+import microdot
+import microdot_asyncio
+
+
+def serve_threaded(app, data):
+    """Serve ``data`` with the handler used by the threaded server and
+    return the bytes sent back."""
+    server, client = socket.socketpair()
+    client.sendall(data)
+    client.shutdown(socket.SHUT_WR)
+    app.handle_request(server, ('127.0.0.1', 1234))
+    return _read_all(client)
+
+
+def serve_poll(app, data):
+    """Serve ``data`` with a :class:`microdot.Connection`, as the poll
+    server does, and return the bytes sent back."""
+    server, client = socket.socketpair()
+    client.sendall(data)
+    client.shutdown(socket.SHUT_WR)
+    conn = microdot.Connection(app, server, ('127.0.0.1', 1234))
+    ok = True
+    while ok:
+        ok = conn.on_write() if conn.writing else conn.on_read()
+    conn.close()
+    return _read_all(client)
+
+
+def serve_asyncio(app, data):
+    """Serve ``data`` with the asyncio server's connection handler and
+    return the bytes sent back."""
+    server, client = socket.socketpair()
+    client.sendall(data)
+    client.shutdown(socket.SHUT_WR)
+
+    async def serve():
+        app._connection_released = asyncio.Event()
+        reader, writer = await asyncio.open_connection(sock=server)
+        # the methods that start_server() adds on CPython
+        writer.awrite = lambda data: _awrite(writer, data)
+        writer.aclose = lambda: _aclose(writer)
+        await app.handle_request(reader, writer)
+
+    asyncio.run(serve())
+    return _read_all(client)
+
+
+async def _awrite(writer, data):
+    writer.write(data)
+    await writer.drain()
+
+
+async def _aclose(writer):
+    writer.close()
+    await writer.wait_closed()
+
+
+def split_responses(data):
+    """Split the bytes sent by the server into a list of
+    ``(status_line, headers, body)`` tuples. Bodies are delimited by their
+    ``Content-Length`` header, by chunked encoding, or by the end of the
+    data. Chunked bodies are returned decoded, with the raw bytes in the
+    ``'_raw'`` header."""
+    responses = []
+    while data:
+        head, data = data.split(b'\r\n\r\n', 1)
+        lines = head.decode().split('\r\n')
+        headers = {}
+        for line in lines[1:]:
+            name, value = line.split(': ', 1)
+            headers[name.lower()] = value
+        if 'content-length' in headers:
+            length = int(headers['content-length'])
+            body, data = data[:length], data[length:]
+        elif headers.get('transfer-encoding') == 'chunked':
+            body = b''
+            start = data
+            while True:
+                size, data = data.split(b'\r\n', 1)
+                size = int(size, 16)
+                body += data[:size]
+                assert data[size:size + 2] == b'\r\n'
+                data = data[size + 2:]
+                if size == 0:
+                    break
+            headers['_raw'] = start[:len(start) - len(data)]
+        else:
+            body, data = data, b''
+        responses.append((lines[0], headers, body))
+    return responses
+
+
+def _read_all(sock):
+    sock.settimeout(5)
+    data = b''
+    while True:
+        chunk = sock.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    sock.close()
+    return data
+
+
+SERVERS = [
+    ('threaded', microdot.Microdot, serve_threaded),
+    ('poll', microdot.Microdot, serve_poll),
+    ('asyncio', microdot_asyncio.Microdot, serve_asyncio),
+]
@@ -0,0 +1,73 @@
+import unittest
+
+import microdot
+from tests.servers import SERVERS, split_responses
+
+
+def create_app(app_class):
+    app = app_class()
+
+    if app_class is microdot.Microdot:
+        @app.route('/stream')
+        def stream(req):
+            def body():
+                yield 'hello, '
+                yield b'world'
+            return body()
+    else:
+        @app.route('/stream')
+        async def stream(req):
+            async def body():
+                yield 'hello, '
+                yield b'world'
+            return body()
+
+    @app.route('/')
+    def index(req):
+        return 'hello'
+
+    return app
+
+
+class TestChunked(unittest.TestCase):
+    def test_http_11_generator(self):
+        for name, app_class, serve in SERVERS:
+            with self.subTest(server=name):
+                data = serve(create_app(app_class),
+                             b'GET /stream HTTP/1.1\r\n\r\n'
+                             b'GET / HTTP/1.1\r\n\r\n')
+                responses = split_responses(data)
+                self.assertEqual(len(responses), 2)
+                status, headers, body = responses[0]
+                self.assertEqual(headers['transfer-encoding'], 'chunked')
+                self.assertNotIn('content-length', headers)
+                self.assertEqual(headers['connection'], 'keep-alive')
+                self.assertEqual(body, b'hello, world')
+                self.assertTrue(headers['_raw'].endswith(
+                    b'\r\n0\r\n\r\n'))
+                self.assertEqual(responses[1][2], b'hello')
+
+    def test_small_chunks_are_coalesced(self):
+        for name, app_class, serve in SERVERS:
+            with self.subTest(server=name):
+                data = serve(create_app(app_class),
+                             b'GET /stream HTTP/1.1\r\n\r\n')
+                headers = split_responses(data)[0][1]
+                self.assertEqual(headers['_raw'],
+                                 b'c\r\nhello, world\r\n0\r\n\r\n')
+
+    def test_http_10_generator(self):
+        for name, app_class, serve in SERVERS:
+            with self.subTest(server=name):
+                data = serve(create_app(app_class),
+                             b'GET /stream HTTP/1.0\r\n'
+                             b'Connection: keep-alive\r\n\r\n'
+                             b'GET / HTTP/1.0\r\n\r\n')
+                responses = split_responses(data)
+                # the body ends when the connection is closed
+                self.assertEqual(len(responses), 1)
+                status, headers, body = responses[0]
+                self.assertNotIn('transfer-encoding', headers)
+                self.assertNotIn('content-length', headers)
+                self.assertEqual(headers['connection'], 'close')
+                self.assertEqual(body, b'hello, world')
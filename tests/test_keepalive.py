@@ -0,0 +1,100 @@
+import unittest
+
+import microdot
+from tests.servers import SERVERS, split_responses
+
+
+def create_app(app_class):
+    app = app_class()
+
+    @app.route('/')
+    def index(req):
+        return 'hello'
+
+    @app.route('/echo', methods=['POST'])
+    def echo(req):
+        return req.body
+
+    if app_class is microdot.Microdot:
+        @app.route('/stream', methods=['POST'])
+        def stream(req):
+            return str(len(req.stream.read(req.content_length)))
+    else:
+        @app.route('/stream', methods=['POST'])
+        async def stream(req):
+            return str(len(await req.stream.readexactly(
+                req.content_length)))
+
+    return app
+
+
+class TestKeepAlive(unittest.TestCase):
+    def test_pipelined_requests(self):
+        for name, app_class, serve in SERVERS:
+            with self.subTest(server=name):
+                data = serve(create_app(app_class),
+                             b'GET / HTTP/1.1\r\n\r\n'
+                             b'POST /echo HTTP/1.1\r\nContent-Length: 3\r\n'
+                             b'\r\nabcGET / HTTP/1.1\r\n\r\n')
+                responses = split_responses(data)
+                self.assertEqual([r[2] for r in responses],
+                                 [b'hello', b'abc', b'hello'])
+                for status, headers, body in responses:
+                    self.assertEqual(status, 'HTTP/1.1 200 OK')
+                    self.assertEqual(headers['connection'], 'keep-alive')
+
+    def test_pipelined_large_body(self):
+        body = bytes(range(256)) * 8
+        for name, app_class, serve in SERVERS:
+            with self.subTest(server=name):
+                data = serve(create_app(app_class),
+                             b'POST /echo HTTP/1.1\r\nContent-Length: ' +
+                             str(len(body)).encode() + b'\r\n\r\n' + body +
+                             b'GET / HTTP/1.1\r\n\r\n')
+                responses = split_responses(data)
+                self.assertEqual([r[2] for r in responses],
+                                 [body, b'hello'])
+
+    def test_streamed_body(self):
+        body = b'x' * 3000
+        max_body_length = microdot.Request.max_body_length
+        microdot.Request.max_body_length = 1000
+        try:
+            for name, app_class, serve in SERVERS:
+                with self.subTest(server=name):
+                    data = serve(create_app(app_class),
+                                 b'POST /stream HTTP/1.1\r\n'
+                                 b'Content-Length: 3000\r\n\r\n' + body)
+                    responses = split_responses(data)
+                    self.assertEqual(responses[0][2], b'3000')
+        finally:
+            microdot.Request.max_body_length = max_body_length
+
+    def test_connection_close(self):
+        for name, app_class, serve in SERVERS:
+            with self.subTest(server=name):
+                data = serve(create_app(app_class),
+                             b'GET / HTTP/1.1\r\nConnection: close\r\n\r\n'
+                             b'GET / HTTP/1.1\r\n\r\n')
+                responses = split_responses(data)
+                self.assertEqual(len(responses), 1)
+                self.assertEqual(responses[0][1]['connection'], 'close')
+
+    def test_http_10(self):
+        for name, app_class, serve in SERVERS:
+            with self.subTest(server=name):
+                data = serve(create_app(app_class),
+                             b'GET / HTTP/1.0\r\n\r\nGET / HTTP/1.0\r\n\r\n')
+                responses = split_responses(data)
+                self.assertEqual(len(responses), 1)
+                self.assertEqual(responses[0][1]['connection'], 'close')
+
+    def test_http_10_keep_alive(self):
+        for name, app_class, serve in SERVERS:
+            with self.subTest(server=name):
+                data = serve(create_app(app_class),
+                             b'GET / HTTP/1.0\r\nConnection: keep-alive\r\n'
+                             b'\r\nGET / HTTP/1.0\r\n\r\n')
+                responses = split_responses(data)
+                self.assertEqual([r[1]['connection'] for r in responses],
+                                 ['keep-alive', 'close'])
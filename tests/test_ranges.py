@@ -0,0 +1,83 @@
+import io
+import os
+import tempfile
+import unittest
+
+from microdot import Microdot, NoCaseDict, Request, Response
+
+DATA = b'0123456789'
+
+
+class TestRanges(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.write(fd, DATA)
+        os.close(fd)
+        self.app = Microdot()
+
+        @self.app.route('/file')
+        def file(req):
+            return Response.send_file(self.filename)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def get(self, range=None):
+        headers = NoCaseDict()
+        if range is not None:
+            headers['Range'] = range
+        req = Request(self.app, ('127.0.0.1', 1234), 'GET', '/file', '1.1',
+                      headers)
+        res = self.app.dispatch_request(req)
+        stream = io.BytesIO()
+        res.write(stream)
+        body = stream.getvalue().split(b'\r\n\r\n', 1)[1]
+        return res, body
+
+    def test_range(self):
+        res, body = self.get('bytes=2-5')
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(res.headers['Content-Range'], 'bytes 2-5/10')
+        self.assertEqual(res.headers['Content-Length'], '4')
+        self.assertEqual(body, b'2345')
+
+    def test_open_ended_range(self):
+        res, body = self.get('bytes=7-')
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(res.headers['Content-Range'], 'bytes 7-9/10')
+        self.assertEqual(body, b'789')
+
+    def test_suffix_range(self):
+        res, body = self.get('bytes=-3')
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(res.headers['Content-Range'], 'bytes 7-9/10')
+        self.assertEqual(body, b'789')
+        res, body = self.get('bytes=-20')
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(body, DATA)
+
+    def test_end_past_eof(self):
+        res, body = self.get('bytes=8-20')
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(res.headers['Content-Range'], 'bytes 8-9/10')
+        self.assertEqual(body, b'89')
+
+    def test_start_past_eof(self):
+        res, body = self.get('bytes=10-')
+        self.assertEqual(res.status_code, 416)
+        self.assertEqual(res.headers['Content-Range'], 'bytes */10')
+        self.assertEqual(body, b'')
+
+    def test_ignored_ranges(self):
+        for range in ('bytes=5-3', 'bytes=a-b', 'bytes=0-1,4-5',
+                      'items=0-1', 'bytes=3'):
+            res, body = self.get(range)
+            self.assertEqual(res.status_code, 200, range)
+            self.assertNotIn('Content-Range', res.headers)
+            self.assertEqual(body, DATA)
+
+    def test_no_range(self):
+        res, body = self.get()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Accept-Ranges'], 'bytes')
+        self.assertEqual(body, DATA)
@@ -0,0 +1,32 @@
+import unittest
+
+from microdot import MultiDict, NoCaseDict, Request
+
+
+def create_request(url='/', headers=None):
+    return Request(None, ('127.0.0.1', 1234), 'GET', url, '1.1',
+                   NoCaseDict(headers or {}))
+
+
+class TestRequest(unittest.TestCase):
+    def test_lazy_attributes(self):
+        req = create_request('/?a=1', {'Cookie': 'b=2',
+                                       'Content-Length': '3',
+                                       'Content-Type': 'text/plain'})
+        self.assertEqual(req.args['a'], '1')
+        self.assertEqual(req.cookies, {'b': '2'})
+        self.assertEqual(req.content_length, 3)
+        self.assertEqual(req.content_type, 'text/plain')
+
+    def test_assign_attributes(self):
+        req = create_request('/?a=1', {'Cookie': 'b=2',
+                                       'Content-Length': '3',
+                                       'Content-Type': 'text/plain'})
+        req.args = MultiDict({'x': 'y'})
+        req.cookies = {}
+        req.content_length = 0
+        req.content_type = 'application/json'
+        self.assertEqual(req.args['x'], 'y')
+        self.assertEqual(req.cookies, {})
+        self.assertEqual(req.content_length, 0)
+        self.assertEqual(req.content_type, 'application/json')
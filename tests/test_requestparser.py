@@ -0,0 +1,202 @@
+r"""Tests for the request parser. They also run on MicroPython, with the
+``unittest`` package from micropython-lib, to check the parser with the
+``bytearray`` of the device::
+
+    mpremote mip install unittest
+    mpremote mount . exec \
+        "import unittest; unittest.main('tests.test_requestparser')"
+"""
+import io
+import random
+import unittest
+
+from microdot import NoCaseDict, Request, RequestParser
+
+CORPUS = [
+    b'GET / HTTP/1.1\r\nHost: a\r\n\r\n',
+    b'GET /x?a=1&b=2 HTTP/1.0\r\nHost:a\r\nCookie: a=1; b=2\r\n'
+    b'X-Y:   spaced value  \r\n\r\nBODY',
+    b'POST /p HTTP/1.1\nContent-Length: 3\n\nabc',
+    b'GET / HTTP/1.1\r\nBad header\r\n\r\n',
+    b'\r\n',
+    b'',
+    b'GET /\r\n\r\n',
+    b'GET / HTTP/1.1\r\nA: b: c\r\n\r\n',
+    b'GET / HTTP/1.1\r\nA:\r\n\r\n',
+    b'GET / HTTP/1.1\r\n  \t\r\nIgnored: yes\r\n\r\n',
+    b'GET / HTTP/1.1\r\nHost: a',
+]
+
+ALPHABET = b'GET /HTP1.\r\n: abcXY-=\t'
+
+BENCHMARK_REQUEST = (
+    b'GET /plantify HTTP/1.1\r\nHost: 192.168.1.20\r\n'
+    b'User-Agent: Mozilla/5.0 (X11; Linux x86_64)\r\n'
+    b'Accept: application/json\r\nAccept-Encoding: gzip, deflate\r\n'
+    b'Connection: keep-alive\r\nOrigin: http://localhost\r\n\r\n')
+
+
+def reference_parse(data):
+    return reference_read(io.BytesIO(data))
+
+
+def reference_read(stream):
+    # the line-by-line parser that RequestParser replaced
+    line = stream.readline().strip().decode()
+    if not line:
+        return None
+    method, url, http_version = line.split()
+    http_version = http_version.split('/', 1)[1]
+    headers = NoCaseDict()
+    while True:
+        line = stream.readline().strip().decode()
+        if line == '':
+            break
+        header, value = line.split(':', 1)
+        headers[header] = value.strip()
+    return method, url, http_version, dict(headers)
+
+
+def parse(data, chunk_size=None):
+    parser = RequestParser()
+    pos = 0
+    while not parser.complete and pos < len(data):
+        if chunk_size is None:
+            end = data.find(b'\n', pos) + 1 or len(data)
+        else:
+            end = pos + chunk_size
+        pos += parser.feed(data[pos:end])
+    parser.end()
+    request = parser.parse()
+    if request is None:
+        return None
+    method, url, http_version, headers = request
+    return method, url, http_version, dict(headers)
+
+
+def outcome(f, *args):
+    try:
+        return f(*args)
+    except (ValueError, IndexError):
+        return 'error'
+
+
+def mutations(count, seed=1):
+    # bytes are sliced instead of using bytearray.insert() and del, which
+    # MicroPython does not have
+    random.seed(seed)
+    for _ in range(count):
+        data = random.choice(CORPUS)
+        for _ in range(random.randint(0, 4)):
+            op = random.random()
+            char = bytes([random.choice(ALPHABET)])
+            if op < 0.4 and data:
+                i = random.randrange(len(data))
+                data = data[:i] + char + data[i + 1:]
+            elif op < 0.7:
+                i = random.randint(0, len(data))
+                data = data[:i] + char + data[i:]
+            elif data:
+                i = random.randrange(len(data))
+                data = data[:i] + data[i + 1:]
+        yield data
+
+
+class TestRequestParser(unittest.TestCase):
+    def test_corpus(self):
+        for data in CORPUS:
+            expected = outcome(reference_parse, data)
+            self.assertEqual(outcome(parse, data), expected, data)
+            for chunk_size in (1, 3, 7, 64):
+                self.assertEqual(outcome(parse, data, chunk_size), expected,
+                                 data)
+
+    def test_fuzz(self):
+        for i, data in enumerate(mutations(5000)):
+            expected = outcome(reference_parse, data)
+            self.assertEqual(outcome(parse, data), expected, data)
+            self.assertEqual(outcome(parse, data, i % 9 + 1), expected,
+                             data)
+
+    def test_body_not_consumed(self):
+        parser = RequestParser()
+        data = b'POST /p HTTP/1.1\r\nContent-Length: 4\r\n\r\nbody'
+        self.assertEqual(parser.feed(data), len(data) - 4)
+        self.assertTrue(parser.complete)
+        self.assertEqual(parser.parse()[3]['Content-Length'], '4')
+
+    def test_reuse(self):
+        parser = RequestParser()
+        parser.feed(b'GET /a HTTP/1.1\r\nX: 1\r\n\r\n')
+        self.assertEqual(parser.parse()[1], '/a')
+        parser.reset()
+        parser.feed(b'GET /b HTTP/1.1\r\n\r\n')
+        self.assertEqual(parser.parse()[1:3], ('/b', '1.1'))
+
+    def test_buffer_growth(self):
+        parser = RequestParser()
+        size = len(parser.buffer)
+        value = 'v' * size
+        parser.feed('GET /a HTTP/1.1\r\nX: {}\r\n\r\n'.format(
+            value).encode())
+        self.assertEqual(parser.parse()[3]['X'], value)
+        self.assertGreater(len(parser.buffer), size)
+        for path in ('/b', '/c'):
+            parser.reset()
+            self.assertEqual(parser.length, 0)
+            parser.feed(b'GET ' + path.encode() + b' HTTP/1.1\r\n\r\n')
+            self.assertEqual(parser.parse(),
+                             ('GET', path, '1.1', NoCaseDict()))
+
+    def test_limits(self):
+        parser = RequestParser()
+        with self.assertRaises(ValueError):
+            parser.feed(b'GET /' + b'a' * Request.max_readline)
+        parser.reset()
+        parser.feed(b'GET / HTTP/1.1\r\n')
+        with self.assertRaises(ValueError):
+            for i in range(Request.max_headers + 1):
+                parser.feed('X-{}: {}\r\n'.format(i, i).encode())
+
+
+if __name__ == '__main__':  # pragma: no cover
+    # micro-benchmark of a typical browser request received over a socket,
+    # read with Request.create() as it was before the parser, one line at a
+    # time, and as it is now, in chunks fed to the parser
+    import socket
+    import time
+
+    server, client = socket.socketpair()
+    stream = server.makefile('rwb')
+    parser = RequestParser()
+
+    def create_by_lines():
+        line = Request._safe_readline(stream).strip().decode()
+        method, url, http_version = line.split()
+        http_version = http_version.split('/', 1)[1]
+        headers = NoCaseDict()
+        while True:
+            line = Request._safe_readline(stream).strip().decode()
+            if line == '':
+                break
+            header, value = line.split(':', 1)
+            headers[header] = value.strip()
+        return Request(None, None, method, url, http_version, headers,
+                       stream=stream)
+
+    def create_by_chunks():
+        return Request.create(None, stream, None, parser=parser)
+
+    # the best of many short rounds, as the two are interleaved
+    best = {create_by_lines: None, create_by_chunks: None}
+    for _ in range(200):
+        for create in best:
+            start = time.perf_counter()
+            for _ in range(100):
+                client.sendall(BENCHMARK_REQUEST)
+                create()
+            t = (time.perf_counter() - start) * 1e6 / 100
+            if best[create] is None or t < best[create]:
+                best[create] = t
+    for create, t in best.items():
+        print('{}: {:.2f} us/request'.format(create.__name__, t))
@@ -0,0 +1,125 @@
+import asyncio
+import io
+import time
+import unittest
+
+import microdot
+import microdot_asyncio
+from microdot import NoCaseDict, Request
+
+
+def create_app(app_class):
+    app = app_class()
+    app.calls = []
+
+    @app.route('/items/<int:id>')
+    @app.cache(ttl=0.2, vary=['headers.Accept-Language'])
+    def item(req, id):
+        app.calls.append(id)
+        return 'item {} {}'.format(id, len(app.calls))
+
+    @app.route('/other')
+    @app.cache()
+    def other(req):
+        app.calls.append('other')
+        return 'x' * 100
+
+    app.item = item
+    return app
+
+
+class TestResponseCache(unittest.TestCase):
+    def get(self, app, path, headers=None):
+        req = Request(app, ('127.0.0.1', 1234), 'GET', path, '1.1',
+                      NoCaseDict(headers or {}))
+        stream = io.BytesIO()
+        if isinstance(app, microdot_asyncio.Microdot):
+            async def dispatch():
+                res = await app.dispatch_request(req)
+
+                async def awrite(data):
+                    stream.write(data)
+
+                stream.awrite = awrite
+                await res.write(stream)
+
+            asyncio.run(dispatch())
+        else:
+            app.dispatch_request(req).write(stream)
+        return stream.getvalue().split(b'\r\n\r\n', 1)[1]
+
+    def for_each_app(self, test):
+        for app_class in (microdot.Microdot, microdot_asyncio.Microdot):
+            with self.subTest(app_class=app_class):
+                test(create_app(app_class))
+
+    def test_hit(self):
+        def test(app):
+            self.assertEqual(self.get(app, '/items/1'), b'item 1 1')
+            self.assertEqual(self.get(app, '/items/1'), b'item 1 1')
+            self.assertEqual(app.calls, [1])
+
+        self.for_each_app(test)
+
+    def test_miss_by_url_args_and_vary(self):
+        def test(app):
+            self.assertEqual(self.get(app, '/items/1'), b'item 1 1')
+            self.assertEqual(self.get(app, '/items/2'), b'item 2 2')
+            self.assertEqual(
+                self.get(app, '/items/1', {'Accept-Language': 'es'}),
+                b'item 1 3')
+            self.assertEqual(
+                self.get(app, '/items/1', {'Accept-Language': 'es'}),
+                b'item 1 3')
+            self.assertEqual(app.calls, [1, 2, 1])
+
+        self.for_each_app(test)
+
+    def test_ttl_expiry(self):
+        def test(app):
+            self.assertEqual(self.get(app, '/items/1'), b'item 1 1')
+            time.sleep(0.25)
+            self.assertEqual(self.get(app, '/items/1'), b'item 1 2')
+            self.assertEqual(app.calls, [1, 1])
+
+        self.for_each_app(test)
+
+    def test_eviction(self):
+        def test(app):
+            self.get(app, '/other')
+            self.get(app, '/items/1')
+            app.cache_max_size = app.response_cache_size + 50
+            # storing a response evicts the least recently used one, /other
+            self.get(app, '/items/2')
+            self.assertLessEqual(app.response_cache_size,
+                                 app.cache_max_size)
+            self.get(app, '/items/1')
+            self.get(app, '/other')
+            self.assertEqual(app.calls, ['other', 1, 2, 'other'])
+
+        self.for_each_app(test)
+
+    def test_too_large_response(self):
+        def test(app):
+            app.cache_max_size = 50
+            self.get(app, '/other')
+            self.get(app, '/other')
+            self.assertEqual(app.calls, ['other', 'other'])
+            self.assertEqual(app.response_cache_size, 0)
+
+        self.for_each_app(test)
+
+    def test_invalidate_cache(self):
+        def test(app):
+            self.get(app, '/items/1')
+            self.get(app, '/other')
+            app.invalidate_cache(app.item)
+            self.get(app, '/items/1')
+            self.get(app, '/other')
+            self.assertEqual(app.calls, [1, 'other', 1])
+            app.invalidate_cache()
+            self.assertEqual(app.response_cache_size, 0)
+            self.get(app, '/other')
+            self.assertEqual(app.calls, [1, 'other', 1, 'other'])
+
+        self.for_each_app(test)
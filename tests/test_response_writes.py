@@ -0,0 +1,90 @@
+import asyncio
+import io
+import unittest
+
+import microdot
+import microdot_asyncio
+
+
+class CountingStream:
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(bytes(data))
+
+    async def awrite(self, data):
+        self.write(data)
+
+
+def sensor_response(response_class):
+    res = response_class({'temperature': 21.5, 'humidity': 48,
+                          'moisture': 63.3, 'timestamp': '2023-06-06'})
+    res.headers['Access-Control-Allow-Origin'] = 'http://localhost'
+    res.headers['Connection'] = 'keep-alive'
+    return res
+
+
+def write(res, sync=True):
+    stream = CountingStream()
+    if sync:
+        res.write(stream)
+    else:
+        asyncio.run(res.write(stream))
+    return stream.writes
+
+
+class TestResponseWrites(unittest.TestCase):
+    def check(self, create, expected_writes):
+        for response_class, sync in ((microdot.Response, True),
+                                     (microdot_asyncio.Response, False)):
+            with self.subTest(response_class=response_class):
+                writes = write(create(response_class), sync)
+                self.assertEqual(len(writes), expected_writes)
+        return writes
+
+    def test_small_body(self):
+        writes = self.check(sensor_response, 1)
+        self.assertTrue(writes[0].startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertTrue(writes[0].endswith(b'"timestamp": "2023-06-06"}'))
+
+    def test_headers_only(self):
+        def head(response_class):
+            res = sensor_response(response_class)
+            res.is_head = True
+            return res
+
+        self.check(head, 1)
+        self.check(lambda cls: cls(status_code=204), 1)
+        self.check(lambda cls: cls.not_modified('"1"'), 1)
+
+    def test_large_body(self):
+        size = microdot.Response.inline_body_size + 1
+        writes = self.check(lambda cls: cls(b'x' * size), 2)
+        self.assertEqual(writes[1], b'x' * size)
+
+    def test_file_body(self):
+        size = microdot.Response.send_file_buffer_size
+
+        def file(response_class):
+            return response_class(io.BytesIO(b'x' * (size * 2 + 1)))
+
+        writes = self.check(file, 4)
+        self.assertEqual([len(w) for w in writes[1:]], [size, size, 1])
+
+    def test_integer_header_values(self):
+        writes = self.check(
+            lambda cls: cls('x', headers={'Retry-After': 1}), 1)
+        self.assertIn(b'\r\nRetry-After: 1\r\n', writes[0])
+
+
+if __name__ == '__main__':  # pragma: no cover
+    # benchmark of a JSON sensor response with CORS and Connection headers
+    import time
+
+    n = 20000
+    start = time.perf_counter()
+    for _ in range(n):
+        writes = write(sensor_response(microdot.Response))
+    print('{} writes/response, {:.2f} us/response'.format(
+        len(writes), (time.perf_counter() - start) * 1e6 / n))
@@ -0,0 +1,53 @@
+import random
+import unittest
+
+from tscodec import BlockEncoder, decode_block, decode_payload, \
+    encode_block, get_varint, put_varint
+
+
+class TestTSCodec(unittest.TestCase):
+    def test_varint(self):
+        for n in [0, 1, -1, 63, -64, 64, -65, 2 ** 39 - 1, -2 ** 39,
+                  2 ** 40, -2 ** 40]:
+            buf = bytearray()
+            put_varint(buf, n)
+            self.assertEqual(get_varint(buf, 0), (n, len(buf)))
+
+    def test_small_deltas(self):
+        block = encode_block([(100, 5), (101, 4), (99, 4)])
+        # 5-byte header, 3-byte keyframe, then one byte per delta
+        self.assertEqual(len(block), 5 + 3 + 4)
+        self.assertEqual(decode_block(block), [(100, 5), (101, 4), (99, 4)])
+
+    def test_empty_block(self):
+        self.assertEqual(decode_block(encode_block([])), [])
+
+    def test_random_round_trip(self):
+        rng = random.Random(0)
+        for _ in range(200):
+            fields = rng.randint(1, 6)
+            bits = rng.choice((7, 16, 32, 40))
+            records = []
+            for _ in range(rng.randint(1, 100)):
+                if records and rng.random() < 0.7:
+                    # small positive and negative deltas
+                    records.append(tuple(v + rng.randint(-3, 3)
+                                         for v in records[-1]))
+                else:
+                    records.append(tuple(
+                        rng.randint(-2 ** bits, 2 ** bits)
+                        for _ in range(fields)))
+            self.assertEqual(decode_block(encode_block(records)), records)
+
+    def test_incremental_encoder(self):
+        records = [(1686002684 + 5 * i, 215 - i, 480 + i % 3, 633)
+                   for i in range(60)]
+        encoder = BlockEncoder(4)
+        for record in records[:30]:
+            encoder.append(record)
+        first = encoder.block()
+        encoder.reset()
+        for record in records[30:]:
+            encoder.append(record)
+        self.assertEqual(decode_block(first) + list(decode_payload(
+            encoder.payload, encoder.count, 4)), records)